@@ -0,0 +1,113 @@
+"""
+Benchmark of the spacy pipeline modes on our stories.
+For each mode, report the parsing speed (tokens/sec) and the PERSON-entity precision, recall and F1 against the
+full pipeline, which serves as the silver reference.
+
+usage:
+    python -m src.analysis.benchmark_pipelines --dir "data/ss/llm_ss/Gemini 2.0 Flash"
+    python -m src.analysis.benchmark_pipelines --human --model en_core_web_sm --limit 50
+"""
+
+import argparse
+import time
+from wasabi import msg, table
+
+from src.data import make_dataset
+from src.models import mcreator
+from src.tools.path_tools import PathTools
+
+_pt = PathTools()
+
+# pipeline modes: name -> stages to enable (None for the whole pipeline)
+MODES = {
+    "full": None,
+    "lite": mcreator.LITE_STAGES,
+}
+
+
+def person_spans(docs:list) -> set:
+    """
+    :return: (doc index, start char, end char) of every PERSON entity
+    """
+    return {
+        (i, ent.start_char, ent.end_char)
+        for i, doc in enumerate(docs) for ent in doc.ents if ent.label_ == "PERSON"
+    }
+
+
+def f1_score(predicted:set, reference:set) -> tuple[float, float, float]:
+    """
+    :return: precision, recall and F1 of exact span matches
+    """
+    true_positives = len(predicted & reference)
+    precision = true_positives / len(predicted) if predicted else 1.0
+    recall = true_positives / len(reference) if reference else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return precision, recall, f1
+
+
+def benchmark(texts:list[str], model:str="en_core_web_trf", modes:dict=MODES, batch_size:int=8, n_process:int=1) -> dict:
+    """
+    :param texts: texts of the stories
+    :param model: name of the spacy pipeline
+    :param modes: {mode name: stages} to compare. The full pipeline is always run first as the reference
+    :return: {mode name: {"components", "tokens", "seconds", "tokens/sec", "precision", "recall", "f1"}}
+    """
+    modes = {"full": None, **{name: stages for name, stages in modes.items() if stages is not None}}
+    results = {}
+    reference = None
+    for name, stages in modes.items():
+        nlp = mcreator.pipelines.get(model, warmup=True, stages=stages)
+        start = time.perf_counter()
+        docs = list(nlp.pipe(texts, batch_size=batch_size, n_process=n_process))
+        seconds = time.perf_counter() - start
+
+        persons = person_spans(docs)
+        if reference is None:
+            reference = persons
+        precision, recall, f1 = f1_score(persons, reference)
+        tokens = sum(len(doc) for doc in docs)
+        results[name] = {
+            "components": nlp.pipe_names,
+            "tokens": tokens,
+            "seconds": seconds,
+            "tokens/sec": tokens / seconds if seconds > 0 else float("inf"),
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the speed and PERSON F1 of the spacy pipeline modes")
+    parser.add_argument("--dir", default=None, help="directory of the story folders, from the root directory")
+    parser.add_argument("--human", action="store_true", help="use the human-written stories instead")
+    parser.add_argument("--model", default="en_core_web_trf", help="name of the spacy pipeline")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of stories")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--n-process", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.human:
+        stories = make_dataset.format_human_ss()
+    elif args.dir is not None:
+        stories = make_dataset.format_ss(_pt.get_target_dir(args.dir))
+    else:
+        raise ValueError("Specify a story directory with --dir or use --human.")
+    texts = list(stories.values())[:args.limit]
+
+    msg.info(f"{len(texts)} stories, model: {args.model}")
+    results = benchmark(texts, model=args.model, batch_size=args.batch_size, n_process=args.n_process)
+    rows = [
+        (
+            name,
+            f"{r['tokens/sec']:.0f}",
+            f"{r['precision']:.3f}",
+            f"{r['recall']:.3f}",
+            f"{r['f1']:.3f}",
+            ", ".join(r["components"]),
+        )
+        for name, r in results.items()
+    ]
+    print(table(rows, header=("mode", "tokens/sec", "PERSON P", "PERSON R", "PERSON F1", "components"), divider=True))
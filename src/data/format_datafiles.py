@@ -3,7 +3,9 @@ import re
 import itertools
 import os
 import string
+import json
 from collections import defaultdict
+import marisa_trie
 from src.tools.path_tools import PathTools
 from src.data import make_dataset
 import pandas as pd
@@ -284,6 +286,71 @@ def format_first_names():
         for femalename in female_list:
             f.write(f"{femalename}\n")
 
+def build_lexicon_artifact(path:str=None):
+    """
+    compile all interim name lists into one versioned binary file that make_dataset memory-maps without parsing
+    layout: fixed header (magic, version, json length) | json header | padding to 8 bytes | marisa BytesTrie
+    :param path: path of the artifact from the root directory. Defaults to make_dataset.LEXICON_ARTIFACT
+    :return:
+    """
+    if path is None:
+        path = make_dataset.LEXICON_ARTIFACT
+    female_names, male_names = make_dataset.get_namelists()
+    female_titles, male_titles, common_titles = make_dataset.get_titles()
+    surnames = make_dataset.get_surnames(namelists=(female_names, male_names))
+    sets = {
+        "female_names": female_names,
+        "male_names": male_names,
+        "female_titles": female_titles,
+        "male_titles": male_titles,
+        "common_titles": common_titles,
+        "surnames": surnames,
+    }
+    maps = {
+        "nickname_for_names": make_dataset.get_hypocorisms(nicknames_for_names=True),
+        "name_for_nicknames": make_dataset.get_hypocorisms(nicknames_for_names=False),
+    }
+    assert set(sets) == set(make_dataset.LEXICON_SET_SECTIONS)
+    assert set(maps) == set(make_dataset.LEXICON_MAP_SECTIONS)
+
+    # set elements have an empty value and each branch of a hypocorism is stored as a separate value of its root
+    items = []
+    for section, elements in sets.items():
+        for element in elements:
+            items.append((f"{section}\t{element}", b""))
+    for section, hypocorisms in maps.items():
+        for initial, roots in hypocorisms.items():
+            for root, branches in roots.items():
+                for branch in branches:
+                    items.append((f"{section}\t{initial}\t{root}", branch.encode("utf-8")))
+    trie_bytes = marisa_trie.BytesTrie(items).tobytes()
+
+    header = {
+        "sections": {section: len(elements) for section, elements in sets.items()},
+        "sources": {
+            source: os.stat(_pt.get_target_dir(source)).st_mtime_ns for source in make_dataset.get_lexicon_sources()
+        },
+        "trie_offset": 0,
+    }
+    # the trie offset is part of the header, so fix the header length first and pad it to 8 bytes
+    fixed_size = make_dataset.LEXICON_ARTIFACT_STRUCT.size
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset = fixed_size + len(header_bytes) + 32
+    offset += -offset % 8
+    header["trie_offset"] = offset
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (offset - fixed_size - len(header_bytes))
+
+    new_path = _pt.get_target_dir(path)
+    os.makedirs(new_path.parent, exist_ok=True)
+    with open(new_path, 'wb') as f:
+        f.write(make_dataset.LEXICON_ARTIFACT_STRUCT.pack(
+            make_dataset.LEXICON_ARTIFACT_MAGIC, make_dataset.LEXICON_ARTIFACT_VERSION, 0, len(header_bytes)
+        ))
+        f.write(header_bytes)
+        f.write(trie_bytes)
+
+
 def format_human_ss_csv(path):
     df = pd.read_csv(path)
     print(df.head())
@@ -1,6 +1,14 @@
 import os
 import string
+import json
+import mmap
+import struct
+import sys
+import time
 from collections import defaultdict
+from collections.abc import Set, Mapping
+from types import MappingProxyType
+import marisa_trie
 from src.data import format_datafiles
 from src.tools.path_tools import PathTools
 _pt = PathTools()
@@ -207,9 +215,10 @@ def get_hypocorisms(nicknames_for_names:bool=True):
         hypocorisms[initial][root].append(branch)
     return hypocorisms
 
-def get_surnames():
+def get_surnames(namelists:tuple=None):
     """
     This returns a set of surnames that also include commonly used first names
+    :param namelists: (female_names, male_names) already loaded by the caller. If None, they are read from the files
     :return:
     """
     path = _pt.get_target_dir('data/interim/surnames/surnames_unique.txt')
@@ -222,7 +231,512 @@ def get_surnames():
         surname = surname.replace("\n", "")
         surname = surname.capitalize()
         surnames.add(surname)
-    female_names, male_names = get_namelists()
+    if namelists is None:
+        namelists = get_namelists()
+    female_names, male_names = namelists
     surnames -= female_names
     surnames -= male_names
     return surnames
+
+
+# interim files read by each lexicon entry of the registry below
+_LEXICON_SOURCES = {
+    "namelists": (
+        "data/interim/first_names/female_namelist.txt",
+        "data/interim/first_names/male_namelist.txt",
+    ),
+    "titles": (
+        "data/interim/unique_titles/female_honorific_titles.txt",
+        "data/interim/unique_titles/male_honorific_titles.txt",
+        "data/interim/unique_titles/common_honorific_titles.txt",
+    ),
+    "hypocorisms_nickname_for_names": (
+        "data/interim/hypocorisms/hypocorisms_nickname_for_names.txt",
+    ),
+    "hypocorisms_name_for_nicknames": (
+        "data/interim/hypocorisms/hypocorisms_name_for_nicknames.txt",
+    ),
+    "surnames": (
+        "data/interim/surnames/surnames_unique.txt",
+        "data/interim/first_names/female_namelist.txt",
+        "data/interim/first_names/male_namelist.txt",
+    ),
+    "all_titles": (
+        "data/interim/unique_titles/female_honorific_titles.txt",
+        "data/interim/unique_titles/male_honorific_titles.txt",
+        "data/interim/unique_titles/common_honorific_titles.txt",
+    ),
+    "hypocorism_index": (
+        "data/interim/hypocorisms/hypocorisms_nickname_for_names.txt",
+        "data/interim/hypocorisms/hypocorisms_name_for_nicknames.txt",
+    ),
+    "gender_table": (
+        "data/interim/unique_titles/female_honorific_titles.txt",
+        "data/interim/unique_titles/male_honorific_titles.txt",
+        "data/interim/first_names/female_namelist.txt",
+        "data/interim/first_names/male_namelist.txt",
+        "data/interim/hypocorisms/hypocorisms_nickname_for_names.txt",
+        "data/interim/hypocorisms/hypocorisms_name_for_nicknames.txt",
+    ),
+}
+
+# integer codes of genders used by the gender table and the name columns
+GENDERS = ("UNKNOWN", "MALE", "FEMALE")
+GENDER_CODES = {gender: code for code, gender in enumerate(GENDERS)}
+
+# compiled lexicon built by format_datafiles.build_lexicon_artifact
+LEXICON_ARTIFACT = "data/processed/lexicon.marisa"
+LEXICON_ARTIFACT_VERSION = 1
+# magic, version, reserved, length of the json header that follows
+LEXICON_ARTIFACT_STRUCT = struct.Struct("<4sHHI")
+LEXICON_ARTIFACT_MAGIC = b"CNLX"
+# sections of the artifact. Every key in the trie is "SECTION\tENTRY" (sets) or "SECTION\tINITIAL\tROOT" (hypocorisms)
+LEXICON_SET_SECTIONS = ("female_names", "male_names", "female_titles", "male_titles", "common_titles", "surnames")
+LEXICON_MAP_SECTIONS = ("nickname_for_names", "name_for_nicknames")
+
+
+def get_lexicon_sources() -> list[str]:
+    """
+    :return: every interim file the lexicon is built from, as a path from the root directory
+    """
+    return sorted({path for paths in _LEXICON_SOURCES.values() for path in paths})
+
+
+class _TrieSet(Set):
+    """
+    Read-only set view of one section of a memory-mapped lexicon trie
+    """
+    def __init__(self, trie, section:str, size:int):
+        self._trie = trie
+        self._prefix = f"{section}\t"
+        self._size = size
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # set operations (|, &, -) return plain frozensets
+        return frozenset(it)
+
+    def __contains__(self, item) -> bool:
+        return isinstance(item, str) and self._prefix + item in self._trie
+
+    def __iter__(self):
+        start = len(self._prefix)
+        for key in self._trie.iterkeys(self._prefix):
+            yield key[start:]
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class _TrieMapping(Mapping):
+    """
+    Read-only view of the hypocorisms of one initial in a memory-mapped lexicon trie: {Root: (Branches)}
+    """
+    def __init__(self, trie, section:str, initial:str):
+        self._trie = trie
+        self._prefix = f"{section}\t{initial}\t"
+        self._size = None
+
+    def __getitem__(self, root:str) -> tuple:
+        if not isinstance(root, str):
+            raise KeyError(root)
+        return tuple(branch.decode("utf-8") for branch in self._trie[self._prefix + root])
+
+    def __contains__(self, root) -> bool:
+        return isinstance(root, str) and self._prefix + root in self._trie
+
+    def __iter__(self):
+        # the trie holds one key per branch, so a root with several branches comes up several times
+        start = len(self._prefix)
+        seen = set()
+        for key in self._trie.iterkeys(self._prefix):
+            if key not in seen:
+                seen.add(key)
+                yield key[start:]
+
+    def __len__(self) -> int:
+        if self._size is None:
+            self._size = sum(1 for _ in self)
+        return self._size
+
+
+class LexiconArtifact:
+    """
+    Memory-mapped lexicon compiled by format_datafiles.build_lexicon_artifact.
+    Nothing is parsed on load: the trie is mapped straight from the file, so forked workers share its pages.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, header_len = LEXICON_ARTIFACT_STRUCT.unpack_from(self._mm, 0)
+        if magic != LEXICON_ARTIFACT_MAGIC:
+            raise ValueError(f"{path} is not a lexicon artifact")
+        if version != LEXICON_ARTIFACT_VERSION:
+            raise ValueError(f"{path} has version {version}, but version {LEXICON_ARTIFACT_VERSION} is required. "
+                             f"Rebuild it with format_datafiles.build_lexicon_artifact")
+        start = LEXICON_ARTIFACT_STRUCT.size
+        self.header = json.loads(bytes(self._mm[start:start + header_len]).decode("utf-8"))
+        self.version = version
+        # {PATH FROM THE ROOT: MTIME OF THE SOURCE FILE WHEN THE ARTIFACT WAS BUILT}
+        self.sources = self.header["sources"]
+
+        self._buffer = memoryview(self._mm)[self.header["trie_offset"]:]
+        self.trie = marisa_trie.BytesTrie()
+        self.trie.map(self._buffer)
+
+    def get_set(self, section:str) -> _TrieSet:
+        return _TrieSet(self.trie, section, self.header["sections"][section])
+
+    def get_hypocorisms(self, section:str) -> MappingProxyType:
+        return MappingProxyType({
+            initial: _TrieMapping(self.trie, section, initial) for initial in string.ascii_uppercase
+        })
+
+    def is_fresh(self, paths:tuple, mtimes:tuple) -> bool:
+        """
+        :param paths: source files of a lexicon entry
+        :param mtimes: current modification times of the files
+        :return: whether the artifact was built from the current version of the files
+        """
+        return all(self.sources.get(path) == mtime for path, mtime in zip(paths, mtimes))
+
+
+class HypocorismIndex:
+    """
+    Flat, bidirectional index of names and their hypocorisms, built from both hypocorism lists.
+    Every string is interned and every lookup is a single dict access:
+    name -> nicknames, nickname -> names, and any string -> all the strings it is transitively connected to
+    (e.g. Bob -> Robert -> Bobby, Rob, ...).
+    """
+    def __init__(self, name_for_nicknames:Mapping, nickname_for_names:Mapping):
+        """
+        :param name_for_nicknames: {INITIALS: {Names: [Hypocorisms]}} as returned by get_hypocorisms(False)
+        :param nickname_for_names: {INITIALS: {Hypocorisms: [Names]}} as returned by get_hypocorisms(True)
+        """
+        nicknames = defaultdict(list)
+        names = defaultdict(list)
+        for roots in name_for_nicknames.values():
+            for name, branches in roots.items():
+                for nickname in branches:
+                    self._link(nicknames, names, name, nickname)
+        for roots in nickname_for_names.values():
+            for nickname, branches in roots.items():
+                for name in branches:
+                    self._link(nicknames, names, name, nickname)
+        self._nicknames = {name: tuple(v) for name, v in nicknames.items()}
+        self._names = {nickname: tuple(v) for nickname, v in names.items()}
+
+        # transitive closure: each string points at the members of its connected component
+        parent = {}
+
+        def find(x):
+            while parent.setdefault(x, x) != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for name, branches in self._nicknames.items():
+            for nickname in branches:
+                parent[find(nickname)] = find(name)
+        components = defaultdict(list)
+        for x in parent:
+            components[find(x)].append(x)
+        self._related = {}
+        for members in components.values():
+            members = tuple(sorted(members))
+            for x in members:
+                self._related[x] = members
+
+    @staticmethod
+    def _link(nicknames:defaultdict, names:defaultdict, name:str, nickname:str) -> None:
+        name = sys.intern(name)
+        nickname = sys.intern(nickname)
+        if nickname not in nicknames[name]:
+            nicknames[name].append(nickname)
+        if name not in names[nickname]:
+            names[nickname].append(name)
+
+    def nicknames(self, name:str) -> tuple:
+        """
+        :return: hypocorisms of a name (e.g. Elizabeth -> Lizzy, Beth, ...). Empty if there are none
+        """
+        return self._nicknames.get(name, ())
+
+    def names(self, nickname:str) -> tuple:
+        """
+        :return: names a hypocorism stands for (e.g. Bill -> William). Empty if there are none
+        """
+        return self._names.get(nickname, ())
+
+    def related(self, name:str) -> tuple:
+        """
+        :return: every name and hypocorism transitively connected to the string, including itself
+        """
+        return self._related.get(name, ())
+
+    def is_name(self, name:str) -> bool:
+        return name in self._nicknames
+
+    def is_nickname(self, name:str) -> bool:
+        return name in self._names
+
+    def __contains__(self, name) -> bool:
+        return name in self._related
+
+    def __iter__(self):
+        return iter(self._related)
+
+    def __len__(self) -> int:
+        return len(self._related)
+
+
+class GenderTable:
+    """
+    Precomputed token -> gender evidence (GENDER_CODES), so that annotating a name costs one lookup per name part.
+    - titles: every gendered title with and without a period (common titles are not gendered)
+    - first names: male and female first names, plus hypocorisms mapped to the gender of their root names
+    """
+    def __init__(self, titles:tuple, namelists:tuple, hypocorisms:HypocorismIndex):
+        """
+        :param titles: female, male, and common titles as returned by get_titles
+        :param namelists: female and male first names as returned by get_namelists
+        :param hypocorisms: index of names and hypocorisms
+        """
+        female_titles, male_titles, _ = titles
+        female_names, male_names = namelists
+        male, female = GENDER_CODES["MALE"], GENDER_CODES["FEMALE"]
+
+        # female titles take precedence over male ones
+        self.titles = {}
+        for gender, elements in ((male, male_titles), (female, female_titles)):
+            for title in elements:
+                self.titles[sys.intern(title)] = gender
+                self.titles[sys.intern(f"{title}.")] = gender
+
+        # a hypocorism takes the gender of its root names if they all agree;
+        # the first-name lists take precedence, and male names over female names
+        self.first_names = {}
+        for nickname in (x for x in hypocorisms if hypocorisms.is_nickname(x)):
+            roots = {
+                male if root in male_names else female if root in female_names else None
+                for root in hypocorisms.names(nickname)
+            }
+            roots.discard(None)
+            if len(roots) == 1:
+                self.first_names[nickname] = roots.pop()
+        for gender, elements in ((female, female_names), (male, male_names)):
+            for name in elements:
+                self.first_names[sys.intern(name)] = gender
+
+    def title_gender(self, title:str) -> int:
+        """
+        :return: gender code of a title ("Mrs", "Mrs." -> FEMALE). UNKNOWN for a common, unknown or empty title
+        """
+        gender = self.titles.get(title)
+        if gender is None and "." in title:
+            # titles with periods inside (e.g. "Mr.s") are looked up without any period as get_titles stores them
+            gender = self.titles.get(title.replace(".", ""))
+        return gender or GENDER_CODES["UNKNOWN"]
+
+    def name_gender(self, first:str) -> int:
+        """
+        :return: gender code of a first name or hypocorism. UNKNOWN for an unknown or empty name
+        """
+        return self.first_names.get(first, GENDER_CODES["UNKNOWN"])
+
+
+class Lexicon:
+    """
+    Process-wide registry of the name lists under data/interim.
+    Each list is read once per process and handed out as frozen sets/dicts, so callers can share them freely.
+    An entry is read again only when the modification time of one of its source files changes.
+    The source files are checked at most once every check_interval seconds, not on every lookup;
+    reload forces a check.
+    If the compiled artifact (LEXICON_ARTIFACT) is up to date, entries are served from it without parsing any file.
+    """
+    def __init__(self, artifact_path:str=LEXICON_ARTIFACT, check_interval:float=1.0):
+        """
+        :param artifact_path: path of the compiled artifact from the root directory. None to always read the files
+        :param check_interval: minimum number of seconds between two checks of the source files.
+            0 checks on every lookup, None only on reload
+        """
+        # {KEY: (MTIMES OF THE SOURCE FILES, FROZEN VALUE)}
+        self._cache = {}
+        # incremented every time stale entries are dropped, so that derived caches can tell the lists changed
+        self.generation = 0
+        self.artifact_path = artifact_path
+        # (MTIME OF THE ARTIFACT, LexiconArtifact)
+        self._artifact = None
+        self.check_interval = check_interval
+        # time.monotonic() of the last check of the source files
+        self._last_check = None
+
+    def _mtimes(self, key:str) -> tuple:
+        return tuple(os.stat(_pt.get_target_dir(path)).st_mtime_ns for path in _LEXICON_SOURCES[key])
+
+    def get_artifact(self):
+        """
+        :return: the memory-mapped artifact, or None if it has not been built
+        """
+        if self.artifact_path is None:
+            return None
+        path = _pt.get_target_dir(self.artifact_path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._artifact = None
+            return None
+        if self._artifact is None or self._artifact[0] != mtime:
+            self._artifact = (mtime, LexiconArtifact(path))
+        return self._artifact[1]
+
+    def check(self, force:bool=False) -> int:
+        """
+        Drop the entries whose source files have been modified since they were loaded.
+        The files are checked at most once every check_interval seconds unless force is True
+
+        :return: the generation after the check
+        """
+        now = time.monotonic()
+        if not force and self._last_check is not None and (
+                self.check_interval is None or now - self._last_check < self.check_interval):
+            return self.generation
+        self._last_check = now
+        stale = [key for key, (mtimes, _) in self._cache.items() if self._mtimes(key) != mtimes]
+        for key in stale:
+            del self._cache[key]
+        if stale:
+            self.generation += 1
+        return self.generation
+
+    def reload(self) -> int:
+        """
+        Check the source files now and reload the modified entries on their next lookup
+
+        :return: the generation after the check
+        """
+        return self.check(force=True)
+
+    def _get(self, key:str, loader, artifact_loader=None):
+        """
+        :param key: key of the entry in _LEXICON_SOURCES
+        :param loader: function that reads the source files and returns a frozen value
+        :param artifact_loader: function that takes a LexiconArtifact and returns the same value
+        :return: the cached value, reloaded if any source file has been modified since the last load
+        """
+        self.check()
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached[1]
+
+        mtimes = self._mtimes(key)
+        artifact = self.get_artifact() if artifact_loader is not None else None
+        if artifact is not None and artifact.is_fresh(_LEXICON_SOURCES[key], mtimes):
+            value = artifact_loader(artifact)
+        else:
+            value = loader()
+        self._cache[key] = (mtimes, value)
+        return value
+
+    def namelists(self) -> tuple[frozenset, frozenset]:
+        """
+        :return: frozen sets of female first names and male first names
+        """
+        def load():
+            female_names, male_names = get_namelists()
+            return frozenset(female_names), frozenset(male_names)
+
+        def load_artifact(artifact):
+            return artifact.get_set("female_names"), artifact.get_set("male_names")
+        return self._get("namelists", load, load_artifact)
+
+    def titles(self) -> tuple[frozenset, frozenset, frozenset]:
+        """
+        :return: frozen sets of female, male, and common titles without a period
+        """
+        def load():
+            return tuple(frozenset(titles) for titles in get_titles())
+
+        def load_artifact(artifact):
+            return tuple(artifact.get_set(section) for section in ("female_titles", "male_titles", "common_titles"))
+        return self._get("titles", load, load_artifact)
+
+    def all_titles(self) -> frozenset:
+        """
+        :return: frozen set of every female, male, and common title without a period, built once per load
+        """
+        def load():
+            female_titles, male_titles, common_titles = self.titles()
+            return frozenset(female_titles) | frozenset(male_titles) | frozenset(common_titles)
+        return self._get("all_titles", load)
+
+    def hypocorisms(self, nicknames_for_names:bool=True) -> MappingProxyType:
+        """
+        Read-only version of get_hypocorisms. The innermost lists are tuples.
+        Note that a missing name raises KeyError instead of returning an empty list.
+
+        :return: MappingProxy{INITIALS: MappingProxy{Names: (Hypocorisms)}}
+        """
+        if nicknames_for_names is True:
+            key = "hypocorisms_nickname_for_names"
+            section = "nickname_for_names"
+        elif nicknames_for_names is False:
+            key = "hypocorisms_name_for_nicknames"
+            section = "name_for_nicknames"
+        else:
+            raise ValueError("For nicknames_for_names, only boolen values are accepted")
+
+        def load():
+            hypocorisms = get_hypocorisms(nicknames_for_names=nicknames_for_names)
+            return MappingProxyType({
+                initial: MappingProxyType({root: tuple(branches) for root, branches in roots.items()})
+                for initial, roots in hypocorisms.items()
+            })
+
+        def load_artifact(artifact):
+            return artifact.get_hypocorisms(section)
+        return self._get(key, load, load_artifact)
+
+    def hypocorism_index(self) -> HypocorismIndex:
+        """
+        :return: flat bidirectional index of both hypocorism lists
+        """
+        def load():
+            return HypocorismIndex(
+                self.hypocorisms(nicknames_for_names=False),
+                self.hypocorisms(nicknames_for_names=True),
+            )
+        return self._get("hypocorism_index", load)
+
+    def gender_table(self) -> GenderTable:
+        """
+        :return: token -> gender evidence table of titles, first names and hypocorisms
+        """
+        def load():
+            return GenderTable(self.titles(), self.namelists(), self.hypocorism_index())
+        return self._get("gender_table", load)
+
+    def surnames(self) -> frozenset:
+        """
+        :return: frozen set of surnames that are not used as first names
+        """
+        def load():
+            return frozenset(get_surnames(namelists=self.namelists()))
+
+        def load_artifact(artifact):
+            return artifact.get_set("surnames")
+        return self._get("surnames", load, load_artifact)
+
+    def clear(self) -> None:
+        """
+        Drop every cached entry. The next call reads the files (or the artifact) again
+        """
+        self._cache.clear()
+        self._artifact = None
+        self.generation += 1
+
+
+# the registry shared by every module in the process
+lexicon = Lexicon()
@@ -0,0 +1,149 @@
+# import libraries
+import hashlib
+import numpy as np
+from spacy.attrs import ORTH, ENT_IOB, ENT_TYPE, IS_TITLE
+from spacy.strings import hash_string
+from spacy.tokens import Doc
+from spacy.util import filter_spans
+
+# import local files
+from src.data import make_dataset
+from src.models import mcreator
+from src.tools.position_index import sentence_starts
+
+"""
+Cascaded named entity recognition.
+A doc is parsed by a fast (small statistical) pipeline first. The sentences whose PERSON predictions look
+unreliable, plus a seeded random sample of the other sentences, are parsed again by an accurate (transformer)
+pipeline, and its entities replace the fast ones in those sentences. doc.ents is modified in place.
+The sample of a doc depends only on the seed and the text of the doc, so re-checking the same doc again
+re-checks the same sentences.
+
+The NER components do not expose per-entity scores, so the lexicon serves as the confidence proxy.
+A sentence is re-checked if it has
+(1) a PERSON entity none of whose tokens is a known first name, hypocorism, or surname, and without a title before it,
+(2) a known name in title case that is not tagged PERSON (missed or mislabelled), or
+(3) a title such as Mr. followed by a title-case token that is not tagged PERSON.
+"""
+
+# ENT_IOB codes: 3 = B(egin), 1 = I(nside)
+_B, _I = 3, 1
+
+
+class CascadeNER:
+    def __init__(self, fast_nlp="en_core_web_sm", accurate_nlp="en_core_web_trf", sample_rate:float=0.05, seed:int=0):
+        """
+        :param fast_nlp: Language object (or model name) that parses the docs first
+        :param accurate_nlp: Language object (or model name) that re-checks the uncertain sentences.
+            A model name is loaded in lite mode with NER only
+        :param sample_rate: share of the other sentences re-checked anyway, to keep the fast model honest
+        :param seed: seed of the sample. The sample of each doc is drawn from a generator seeded with
+            this seed and a hash of the text of the doc
+        """
+        if isinstance(fast_nlp, str):
+            fast_nlp = mcreator.pipelines.get(fast_nlp, stages=mcreator.LITE_STAGES)
+        if isinstance(accurate_nlp, str):
+            accurate_nlp = mcreator.pipelines.get(accurate_nlp, stages=("characters",))
+        self.fast_nlp = fast_nlp
+        self.accurate_nlp = accurate_nlp
+        self.sample_rate = sample_rate
+        self.seed = seed
+        # number of sentences seen and re-checked
+        self.sentences = 0
+        self.rechecked = 0
+
+        female_names, male_names = make_dataset.lexicon.namelists()
+        names = set(female_names) | set(male_names) | set(make_dataset.lexicon.hypocorism_index()) \
+            | set(make_dataset.lexicon.surnames())
+        titles = {t for title in make_dataset.lexicon.all_titles() for t in (title, f"{title}.")}
+        # string hashes do not depend on the StringStore, so the ORTH values of the lexicon are computed once
+        to_array = lambda words: np.array([hash_string(w) for w in words], dtype=np.uint64).astype(np.int64)
+        self._name_hashes = to_array(names)
+        self._title_hashes = to_array(titles)
+
+    def _rng(self, doc:Doc) -> np.random.Generator:
+        """
+        :return: random generator of the sample of a doc, the same for the same seed and text
+        """
+        digest = hashlib.sha256(doc.text.encode("utf-8")).digest()
+        return np.random.default_rng([self.seed, int.from_bytes(digest[:8], "little")])
+
+    def uncertain_sentences(self, doc:Doc) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param doc: doc parsed by the fast pipeline
+        :return: start token of each sentence, and whether each sentence should be re-checked
+        """
+        starts = sentence_starts(doc)
+        if len(doc) == 0:
+            return starts, np.zeros(0, dtype=bool)
+
+        orth, iob, ent_type, is_title = doc.to_array([ORTH, ENT_IOB, ENT_TYPE, IS_TITLE]).astype(np.int64, copy=False).T
+        known = np.isin(orth, self._name_hashes)
+        title = np.isin(orth, self._title_hashes)
+        person = np.isin(iob, [_B, _I]) & (ent_type == doc.vocab.strings["PERSON"])
+
+        uncertain_tokens = np.zeros(len(doc), dtype=bool)
+        # (1) PERSON entities without any lexicon support
+        ent_starts = np.flatnonzero(person & (iob == _B))
+        if len(ent_starts) > 0:
+            breaks = np.append(np.flatnonzero(iob != _I), len(doc))
+            ent_ends = breaks[np.searchsorted(breaks, ent_starts, side="right")]
+            known_before = np.concatenate([[0], np.cumsum(known)])
+            supported = known_before[ent_ends] - known_before[ent_starts] > 0
+            titled = (ent_starts > 0) & title[np.maximum(ent_starts - 1, 0)]
+            uncertain_tokens[ent_starts[~(supported | titled)]] = True
+        # (2) known names in title case outside PERSON entities
+        uncertain_tokens |= known & (is_title == 1) & ~person
+        # (3) a title followed by a title-case token outside PERSON entities
+        after_title = np.zeros(len(doc), dtype=bool)
+        after_title[1:] = title[:-1]
+        uncertain_tokens |= after_title & (is_title == 1) & ~person
+
+        sent_ids = np.searchsorted(starts, np.flatnonzero(uncertain_tokens), side="right") - 1
+        uncertain = np.zeros(len(starts), dtype=bool)
+        uncertain[sent_ids] = True
+        # a seeded sample of the other sentences
+        uncertain |= self._rng(doc).random(len(starts)) < self.sample_rate
+        return starts, uncertain
+
+    def __call__(self, doc:Doc) -> Doc:
+        """
+        Re-check the uncertain sentences of a doc with the accurate pipeline and merge the entities.
+        The doc is modified in place: doc.ents is overwritten
+
+        :param doc: doc parsed by the fast pipeline
+        :return: the same doc object with the entities of the re-checked sentences replaced
+        """
+        starts, uncertain = self.uncertain_sentences(doc)
+        self.sentences += len(starts)
+        if not uncertain.any():
+            return doc
+        ends = np.append(starts[1:], len(doc))
+        spans = [doc[start:end] for start, end in zip(starts[uncertain].tolist(), ends[uncertain].tolist())]
+        self.rechecked += len(spans)
+
+        # entities of the fast pipeline outside the re-checked sentences
+        rechecked = np.zeros(len(doc), dtype=bool)
+        for span in spans:
+            rechecked[span.start:span.end] = True
+        ents = [ent for ent in doc.ents if not rechecked[ent.start:ent.end].any()]
+
+        # entities of the accurate pipeline, mapped back by character offsets
+        for span, sub_doc in zip(spans, self.accurate_nlp.pipe([span.text for span in spans])):
+            for ent in sub_doc.ents:
+                new = doc.char_span(
+                    span.start_char + ent.start_char,
+                    span.start_char + ent.end_char,
+                    label=ent.label_,
+                    alignment_mode="expand",
+                )
+                if new is not None:
+                    ents.append(new)
+        doc.ents = filter_spans(ents)
+        return doc
+
+    def parse(self, text:str) -> Doc:
+        """
+        Parse a text with the fast pipeline and re-check it
+        """
+        return self(self.fast_nlp(text))
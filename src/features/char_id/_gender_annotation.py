@@ -1,44 +1,77 @@
 
 # import libraries
 from collections import defaultdict
+import numpy as np
 import spacy
+from spacy.attrs import LOWER, ENT_IOB
 from spacy.matcher import Matcher
 from copy import deepcopy
 
 # import local files
 from src.data import make_dataset
+from src.tools.data_based_name_parser import ParsedNameColumns, GENDERS, GENDER_CODES
+
+# possessive and reflexive pronouns counted to the right of a name (https://aclanthology.org/W14-0905/)
+MALE_PRONOUNS = ("his", "himself")
+FEMALE_PRONOUNS = ("her", "herself")
+PRONOUN_WINDOW = 3
 
 class GenderAnnotation:
-    def __init__(self, nlp, doc, chars:defaultdict):
+    def __init__(self, nlp, doc, chars:defaultdict, columns:ParsedNameColumns=None):
         """
+        :param doc: spacy Doc, or a dictionary of Doc objects whose tokens the occurrences index globally
+        :param chars: dictionary of names and Character objects
+        :param columns: parsed names of chars. Built from chars if None
         """
 
         self.nlp = nlp
         self.doc = doc
+        self.docs = doc if isinstance(doc, dict) else {0: doc}
         self.chars = chars
+        if columns is None:
+            columns = ParsedNameColumns(list(chars), [character.name_parsed for character in chars.values()])
+        self.columns = columns
+
+    def annotate(self, chars, pronoun_genders:dict=None):
+        """
+        Resolve the gender of every character in one pass over the name columns.
+        The title and the first name (hypocorisms included) of each name are looked up in the gender table once,
+        and combined as follows:
+        if they agree or only one of them is known, that gender is used; otherwise, the pronoun evidence is used.
+
+        :param chars: AllCharacters object whose genders are updated
+        :param pronoun_genders: {name: gender} from annotate_gender_by_pronouns. UNKNOWN for every name if None
+        :return: chars with the genders updated
+        """
+        columns = chars.name_columns()
+        unknown = GENDER_CODES["UNKNOWN"]
+        title = columns.title_gender
+        first = columns.first_gender
+        if pronoun_genders is None:
+            pronoun = np.full(len(columns), unknown, dtype=np.int8)
+        else:
+            pronoun = np.array([GENDER_CODES[pronoun_genders[name]] for name in columns.names], dtype=np.int8)
+
+        # the known one of title and first name, or the pronoun gender if they conflict
+        merged = np.where(
+            title == unknown,
+            first,
+            np.where((first == unknown) | (first == title), title, pronoun),
+        )
+        # the pronoun gender if neither title nor first name is known
+        merged = np.where(merged == unknown, pronoun, merged)
+
+        # the columns are aligned to the character IDs
+        for id, code in enumerate(merged.tolist()):
+            chars.update_gender(id, GENDERS[code])
+        return chars
 
     def annotate_gender_by_titles_simple(self):
-        female_titles, male_titles, _ = make_dataset.get_titles()
-        name_genders = {
-            name: "UNKNOWN" for name in list(self.chars.keys())
+        # the title gender column comes from the gender table, female titles first
+        return {
+            name: GENDERS[code] for name, code in zip(self.columns.names, self.columns.title_gender.tolist())
         }
 
-        for name, character_obj in self.chars.items():
-            title:str = character_obj.name_parsed.title
-            # remove a period
-            title = title.replace(".", "")
-
-            if title == '':
-                continue
-            else:
-                if title in female_titles:
-                    name_genders[name] = "FEMALE"
-                elif title in male_titles:
-                    name_genders[name] = "MALE"
-                else:
-                    name_genders[name] = "UNKNOWN"
-        return name_genders
-
     @DeprecationWarning
     def annotate_gender_by_titles(self):
         """
@@ -46,7 +79,7 @@ class GenderAnnotation:
         :return:
         """
         # identification by titles
-        female_titles, male_titles, _ = make_dataset.get_titles()
+        female_titles, male_titles, _ = make_dataset.lexicon.titles()
 
         name_genders = {}
         for name in list(self.chars.keys()):
@@ -86,7 +119,7 @@ class GenderAnnotation:
         #   s{0,2} means the s can appear 0 through 2 times
         #   .? means the period can appear 0 or 1 time
         # with the REGEX expression, we can cover Mr., Mrs., Miss., and Mis., with/without a following period
-        titles = male_titles.union(female_titles)
+        titles = male_titles | female_titles
         normal_expression = ""
         for title in titles:
             normal_expression += f"{title}\.?|"
@@ -108,125 +141,57 @@ class GenderAnnotation:
 
     def annotate_gender_by_names(self):
         # identificaiton by name
-        female_names, male_names = make_dataset.get_namelists()
-        names = list(self.chars.keys()).copy()
-        name_genders = {}
-
-        for name in list(names):
-            first = self.chars[name].name_parsed.first
-            if first in male_names:
-                name_genders[name] = "MALE"
-            elif first in female_names:
-                name_genders[name] = "FEMALE"
-            else:
-                # this condition includes a case where first is None
-                name_genders[name] = "UNKNOWN"
-        return name_genders
-
-    def annotate_gender_by_pronouns(self):
-        names = list(self.chars.keys())
-        name_genders = {}
-        # identification by pronouns
-        for name in names:
-            # get a list of indexes of a propernoun appearing in the doc
-            spans = self.chars[name].occurences
-            # get a list of pronouns appearing in the sentences that each propernoun is in
-            pronouns = self._find_pronouns(spans)
-            # assign the most likely gender to the character from the list of pronouns
-            gender = self._assign_gender_by_pronouns(pronouns)
-            name_genders[name] = gender
-        return name_genders
-
-    def _find_pronouns(self, token_idxes):
-        mentions = []
-        i = 0
-        j = 0
-        start = 0
-        end = 0
-        while j < len(list(self.doc.sents))-1:
-
-            # print(f"j: {j}")
-            # print(f"i: {i}")
-
-            # i is for indexing a token
-            # j is for indexing a sentence
-            # start is the number of tokens until the beginning of each sentence
-            # end is the number of tlekns until the end of each sentence
-            token_idx = token_idxes[i]
-
-            # print(token_idx)
-
-            # if the sentence is not the first one, add the length of previous sentence to start
-            if j > 0:
-                start += len(list(list(self.doc.sents)[j-1]))
-            sent = list(self.doc.sents)[j]
-            end += len(list(sent))
-
-            # print(sent)
-            # print(f"start: {start}")
-            # print(f"end: {end}")
-
-            # continue to scan through teh sentence if the token index is inside sentence
-            # purposefully, also extract the pronouns even if a new token index appears in the sentence,
-            # assuming that concurrent appearences strongly indicate the gender tallying the pronouns
-            while start <= token_idx < end and i < len(token_idxes)-1:
-                pronouns = self._match_pronouns(sent)
-                mentions += pronouns
-                i += 1
-                token_idx = token_idxes[i]
-
-                # print(pronouns)
-                # print("\t =====================================================================")
-            j += 1
-            # print("------------------------------------------------")
-        return mentions
-
-    def _match_pronouns(self, sent):
-        """
-        find pronouns from a sentence
-        :param sent: Spacy Sentence
-        :return: a list of pronouns in SpaCy token
-        """
-        male_pattern = [
-            {"LOWER": {"IN": ["he", "his", "him", "himself"]}}
-        ]
-        female_pattern = [
-            {"LOWER": {"IN": ["she", "her", "hers", "herself"]}}
-        ]
-
-        matcher = Matcher(self.nlp.vocab)
-        matcher.add("PRONOUN", [male_pattern, female_pattern])
-        matches = matcher(sent)
-
-        pronouns = []
-        for match in matches:
-            # print(f"match: {match}")
-            pronouns.append(sent[match[1]:match[2]])
-        return pronouns
+        # the first-name gender column comes from the gender table: male names first, then female names,
+        # then hypocorisms by the gender of their root names. A missing first name is UNKNOWN
+        return {
+            name: GENDERS[code] for name, code in zip(self.columns.names, self.columns.first_gender.tolist())
+        }
 
-    def _assign_gender_by_pronouns(self, pronouns, threshold = 0.8):
+    def annotate_gender_by_pronouns(self, window:int=PRONOUN_WINDOW, threshold:float=0.8) -> dict:
         """
-        This method takes a list of pronouns and determines the gender based on the most appearing gender categories
-        :param pronouns: list
-        :return: the most likely gender
+        "a counter keeps track of counts of ‘his’ and ‘himself’ (on the one hand), and of ‘her’ and ‘herself’
+        (on the other) appearing in a window of at most 3 words to the right of the name."
+        (https://aclanthology.org/W14-0905/)
+        The pronouns are counted in one pass over the token arrays of the doc with prefix sums.
+
+        :param window: number of tokens to the right of each mention
+        :param threshold: minimum share of the pronouns of one gender to assign that gender
+        :return: {name: gender}
         """
-        male, female = 0, 0
-        size = len(pronouns)
-        male_pronouns = ["he", "his", "him", "himself"]
-        female_pronouns = ["she", "her", "hers", "herself"]
-        for pron in pronouns:
-            if pron.text.lower() in male_pronouns:
-                male += 1
-            elif pron.text.lower() in female_pronouns:
-                female += 1
-
-        gender = 'UNKNOWN'
-        if male > female:
-            # if the male pronouns are more than the percentile of the threshold of the whole list
-            if male/size >= threshold:
-                gender = "MALE"
-        elif female > male:
-            # if the female pronouns are more than the percentile of the threshold of the whole list
-            if female/size >= threshold:
-                gender = "FEMALE"
-        return gender
+        names = list(self.chars.keys())
+        n_tokens = sum(len(doc) for doc in self.docs.values())
+        if n_tokens == 0 or len(names) == 0:
+            return {name: "UNKNOWN" for name in names}
+
+        # token arrays of all docs, in the global token order of the occurrences
+        tokens = np.concatenate(
+            [doc.to_array([LOWER, ENT_IOB]).reshape(-1, 2) for doc in self.docs.values()]
+        ).astype(np.int64, copy=False)
+        lower, iob = tokens.T
+        strings = next(iter(self.docs.values())).vocab.strings
+        male = np.isin(lower, np.array([strings[p] for p in MALE_PRONOUNS], dtype=np.uint64).astype(np.int64))
+        female = np.isin(lower, np.array([strings[p] for p in FEMALE_PRONOUNS], dtype=np.uint64).astype(np.int64))
+        # number of male/female pronouns before each token index
+        male_before = np.concatenate([[0], np.cumsum(male)])
+        female_before = np.concatenate([[0], np.cumsum(female)])
+
+        # every mention with the index of its name
+        starts = [np.frombuffer(self.chars[name].occurences, dtype=np.int32) for name in names]
+        owners = np.repeat(np.arange(len(names)), [len(s) for s in starts])
+        starts = np.concatenate(starts).astype(np.int64)
+
+        # a mention ends right before the first token after its start that does not continue an entity
+        breaks = np.append(np.flatnonzero(iob != 1), n_tokens)
+        ends = breaks[np.searchsorted(breaks, starts, side="right")]
+        window_ends = np.minimum(ends + window, n_tokens)
+
+        male_counts = np.bincount(owners, weights=male_before[window_ends] - male_before[ends], minlength=len(names))
+        female_counts = np.bincount(owners, weights=female_before[window_ends] - female_before[ends], minlength=len(names))
+        total = male_counts + female_counts
+
+        # the most frequent gender if its share reaches the threshold
+        with np.errstate(divide="ignore", invalid="ignore"):
+            is_male = (male_counts > female_counts) & (male_counts / total >= threshold)
+            is_female = (female_counts > male_counts) & (female_counts / total >= threshold)
+        genders = np.where(is_male, "MALE", np.where(is_female, "FEMALE", "UNKNOWN"))
+        return dict(zip(names, genders.tolist()))
@@ -0,0 +1,112 @@
+# import libraries
+import numpy as np
+from collections import defaultdict
+from spacy.attrs import ENT_IOB
+from spacy.matcher import PhraseMatcher
+
+# import local files
+from src.data import make_dataset
+from src.tools.character import AllCharacters, SOURCE_MATCHER
+
+"""
+Recall sweep over the mentions the NER missed.
+Once the characters are detected, every name, the name without its title (and its first name + surname),
+the first name and surname of every name, and the hypocorisms of every first name become phrase patterns of one PhraseMatcher, which finds all their exact (case-sensitive)
+mentions in a single pass over the tokens. The new mentions are appended to the occurrences of the characters
+with the source SOURCE_MATCHER.
+
+A phrase is attributed to one character only:
+(1) a whole name wins over a name without its title, that over a name part, and a name part over a hypocorism,
+(2) a phrase shared by several characters at the same level (e.g. "Holmes" in "Sherlock Holmes" and
+"Mycroft Holmes") is ambiguous and skipped,
+(3) a phrase that is not capitalized or consists of stop words only (e.g. "Will") is skipped.
+Matches that overlap an entity of the NER, whatever its label, are skipped, and overlapping matches keep the
+longest (then the leftmost) one, so "Sherlock Holmes" is one mention of "Mr. Sherlock Holmes",
+not a mention of "Sherlock" and another of "Holmes".
+"""
+
+# priority of the phrases: the lower the stronger
+_NAME, _BARE_NAME, _PART, _HYPOCORISM = 0, 1, 2, 3
+
+
+def name_phrases(chars:AllCharacters) -> dict[str, tuple[str, int]]:
+    """
+    :param chars: detected characters
+    :return: {phrase: (name of the character, number of leading title tokens to skip)} of the unambiguous phrases
+    """
+    hypocorisms = make_dataset.lexicon.hypocorism_index()
+    # phrase -> priority -> names of the characters
+    candidates = defaultdict(lambda: defaultdict(set))
+    for name, char in chars.chars.items():
+        candidates[name][_NAME].add(name)
+        first, last = char.name_parsed.first, char.name_parsed.last
+        # the name without its title, e.g. "Sherlock Holmes" for "Mr. Sherlock Holmes"
+        title = char.name_parsed.title
+        bare_names = {f"{first} {last}"} if first and last else set()
+        if title and name.startswith(f"{title} "):
+            bare_names.add(name[len(title):].strip())
+        for bare_name in bare_names - {name}:
+            candidates[bare_name][_BARE_NAME].add(name)
+        for part in (first, last):
+            if part and part != name:
+                candidates[part][_PART].add(name)
+        if first:
+            for nickname in hypocorisms.nicknames(first):
+                candidates[nickname][_HYPOCORISM].add(name)
+
+    phrases = {}
+    for phrase, levels in candidates.items():
+        names = levels[min(levels)]
+        if len(names) == 1 and phrase[:1].isupper():
+            name = next(iter(names))
+            # a whole name that starts with its title is counted from the token after the title, as in detection
+            title = chars.chars[name].name_parsed.title
+            skip = 1 if min(levels) == _NAME and title and phrase.startswith(f"{title} ") else 0
+            phrases[phrase] = (name, skip)
+    return phrases
+
+
+def sweep_mentions(nlp, chars:AllCharacters, docs:dict, offsets:list[int]) -> int:
+    """
+    Find the remaining exact mentions of the characters and append them to their occurrences
+
+    :param nlp: spacy Language object that parsed the docs; only its tokenizer is used
+    :param chars: detected characters
+    :param docs: dictionary of Doc objects of the story
+    :param offsets: global token offset of each doc, in the order of docs
+    :return: number of mentions added
+    """
+    phrases = name_phrases(chars)
+    if not phrases:
+        return 0
+
+    matcher = PhraseMatcher(nlp.vocab, attr="ORTH")
+    keys = {}
+    for phrase, target in phrases.items():
+        pattern = nlp.make_doc(phrase)
+        if len(pattern) == 0 or all(token.is_stop for token in pattern):
+            continue
+        key = nlp.vocab.strings.add(phrase)
+        keys[key] = target
+        matcher.add(phrase, [pattern])
+
+    names, starts = [], []
+    for doc, offset in zip(docs.values(), offsets):
+        if len(doc) == 0:
+            continue
+        # ENT_IOB: 3 = B(egin), 1 = I(nside)
+        covered = np.isin(doc.to_array([ENT_IOB]).astype(np.int64, copy=False).reshape(-1), [1, 3])
+        covered_before = np.concatenate([[0], np.cumsum(covered)])
+        # the longest match first, then the leftmost one
+        matches = sorted(matcher(doc), key=lambda m: (m[1] - m[2], m[1]))
+        taken = np.zeros(len(doc), dtype=bool)
+        for key, start, end in matches:
+            if covered_before[end] - covered_before[start] > 0 or taken[start:end].any():
+                continue
+            taken[start:end] = True
+            name, skip = keys[key]
+            names.append(name)
+            starts.append(start + skip + offset)
+
+    chars.add_mentions(names, starts, source=SOURCE_MATCHER)
+    return len(starts)
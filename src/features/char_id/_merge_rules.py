@@ -0,0 +1,91 @@
+# import libraries
+import numpy as np
+
+# import local files
+from src.data.make_dataset import GENDER_CODES
+from src.tools.data_based_name_parser import ParsedNameColumns
+
+"""
+Merge constraints over candidate pairs of characters (https://aclanthology.org/D15-1088/)
+Two vertices cannot be merged if
+(1) the inferred genders of both names differ,
+(2) both names share a common surname but different first names, or
+(3) the honorific of both names differ, e.g., “Miss” and “Mrs.”
+
+Every rule takes the name columns, the gender code of each character ID and the candidate pairs
+as two int arrays of character IDs, and returns a boolean mask of the pairs the rule forbids.
+A rule set is a tuple of rules; a pair is kept only if no rule in the set forbids it.
+"""
+
+UNKNOWN = GENDER_CODES["UNKNOWN"]
+
+
+def gender_differs(columns:ParsedNameColumns, genders:np.ndarray, left:np.ndarray, right:np.ndarray) -> np.ndarray:
+    """
+    (1) strict: the genders are not identical, UNKNOWN included
+    """
+    return genders[left] != genders[right]
+
+
+def gender_conflicts(columns:ParsedNameColumns, genders:np.ndarray, left:np.ndarray, right:np.ndarray) -> np.ndarray:
+    """
+    (1) loose: both genders are known and they differ
+    """
+    g1, g2 = genders[left], genders[right]
+    return (g1 != UNKNOWN) & (g2 != UNKNOWN) & (g1 != g2)
+
+
+def first_names_differ(columns:ParsedNameColumns, genders:np.ndarray, left:np.ndarray, right:np.ndarray) -> np.ndarray:
+    """
+    (2) both names share a surname but have different first names
+    """
+    last1, last2 = columns.last_code[left], columns.last_code[right]
+    first1, first2 = columns.first_code[left], columns.first_code[right]
+    return (last1 != -1) & (last1 == last2) & (first1 != -1) & (first2 != -1) & (first1 != first2)
+
+
+def titles_differ(columns:ParsedNameColumns, genders:np.ndarray, left:np.ndarray, right:np.ndarray) -> np.ndarray:
+    """
+    (3) both names have a title and the titles differ
+    """
+    title1, title2 = columns.title_code[left], columns.title_code[right]
+    return (title1 != -1) & (title2 != -1) & (title1 != title2)
+
+
+RULE_SETS = {
+    # rules (1) and (3) with strict gender equality
+    "strict": (gender_differs, titles_differ),
+    # all three rules of D15-1088
+    "d15": (gender_differs, first_names_differ, titles_differ),
+    # rules (1) and (3), an UNKNOWN gender matches any gender
+    "loose": (gender_conflicts, titles_differ),
+}
+
+
+def get_rules(rules) -> tuple:
+    """
+    :param rules: name of a rule set in RULE_SETS, or a tuple of rule functions
+    :return: tuple of rule functions
+    """
+    if isinstance(rules, str):
+        if rules not in RULE_SETS:
+            raise ValueError(f"Unknown rule set: {rules}. Choose from {list(RULE_SETS.keys())}.")
+        return RULE_SETS[rules]
+    return tuple(rules)
+
+
+def apply_rules(rules, columns:ParsedNameColumns, genders:np.ndarray, left:np.ndarray, right:np.ndarray) -> np.ndarray:
+    """
+    Evaluate a rule set over all candidate pairs at once.
+
+    :param rules: name of a rule set in RULE_SETS, or a tuple of rule functions
+    :param columns: parsed name columns indexed by character ID
+    :param genders: gender code of each character ID
+    :param left: character IDs of the first element of each pair
+    :param right: character IDs of the second element of each pair
+    :return: boolean mask of the pairs that may be merged
+    """
+    keep = np.ones(len(left), dtype=bool)
+    for rule in get_rules(rules):
+        keep &= ~rule(columns, genders, left, right)
+    return keep
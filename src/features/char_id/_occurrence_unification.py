@@ -2,6 +2,7 @@
 import collections
 
 import src.tools.character
+from src.tools.data_based_name_parser import ParsedNameColumns
 # import local files
 from src.data import make_dataset
 import itertools
@@ -37,9 +38,16 @@ class OccurrenceUnification:
     e.g. Mr. Holmes, Holmes, and Sherlock should all refer to Mr. Sherlock Holmes
     """
 
-    def __init__(self, chars:dict):
+    def __init__(self, chars:dict, columns:ParsedNameColumns=None):
+        """
+        :param chars: dictionary of names and Character objects
+        :param columns: parsed names of chars in the same order as chars. Built from chars if None
+        """
         self.chars = chars
-        self.hypocorisms = make_dataset.get_hypocorisms(nicknames_for_names=False)
+        self.hypocorisms = make_dataset.lexicon.hypocorism_index()
+        if columns is None:
+            columns = ParsedNameColumns(list(chars), [character.name_parsed for character in chars.values()])
+        self.columns = columns
 
         # a dict for storing possible referents of each name
         self.char_referents = {
@@ -60,17 +68,14 @@ class OccurrenceUnification:
             name: [] for name in list(self.chars)
         }
 
-        for name, character in self.chars.items():
-            # get the first name
-            first = character.name_parsed.first
+        for name, first in zip(self.columns.names, self.columns.first.tolist()):
             # if the character doesn't have a first name, then skip it
             if first == '':
                 continue
-            initial = first.upper()[0]
-            # if the name is in the name list at the "initial" index
-            if initial in self.hypocorisms.keys() and first in self.hypocorisms[initial].keys():
-                # add the list of referents to the self.char_referents list
-                char_referents[name] = self.hypocorisms[initial][first]
+            # add the hypocorisms of the first name (if any) to the referents
+            nicknames = self.hypocorisms.nicknames(first)
+            if nicknames:
+                char_referents[name] = nicknames
     
         return char_referents
 
@@ -91,8 +96,15 @@ class OccurrenceUnification:
             name: [] for name in list(self.chars)
         }
 
-        for name, character in self.chars.items():
-            possible_ref = self.get_possible_referent(character)
+        columns = zip(
+            self.columns.names,
+            self.columns.title.tolist(),
+            self.columns.first.tolist(),
+            self.columns.last.tolist(),
+            self.columns.middle.tolist(),
+        )
+        for name, title, first, last, middle in columns:
+            possible_ref = self.get_possible_referent_from_parts(title, first, last, middle)
             # exclude blank referents
             referents = [ref for ref in possible_ref.values() if ref]
             char_referents[name] = list(self.flatten(referents))
@@ -110,11 +122,17 @@ class OccurrenceUnification:
         """
         reference: https://aclanthology.org/W14-0905/
         """
-
-        title = character.name_parsed.title
-        first = character.name_parsed.first
-        last = character.name_parsed.last
-        middle = character.name_parsed.middle
+        return self.get_possible_referent_from_parts(
+            character.name_parsed.title,
+            character.name_parsed.first,
+            character.name_parsed.last,
+            character.name_parsed.middle,
+        )
+
+    def get_possible_referent_from_parts(self, title:str, first:str, last:str, middle:str):
+        """
+        reference: https://aclanthology.org/W14-0905/
+        """
 
         possible = {
             "title first last": '',
@@ -150,7 +168,7 @@ class OccurrenceUnification:
             possible["title first last"] = f"{title} {first} {last}"
             # add a period after an initial
             possible["title first_ini last"] = f"{title} {initial}. {last}"
-            for nickname in self.hypocorisms[initial][first]:
+            for nickname in self.hypocorisms.nicknames(first):
                 possible["title nickname last"].append(f"{title} {nickname} {last}")
                 # if the name contians a middle name
                 if middle != '':
@@ -172,12 +190,9 @@ class OccurrenceUnification:
         possible["first"] = first
         possible["last"] = last
 
-        if initial not in self.hypocorisms.keys() or first not in self.hypocorisms[initial].keys():
-            return possible
-        else:
-            for nickname in self.hypocorisms[initial][first]:
-                possible['nickname last'].append(f"{nickname} {last}")
+        for nickname in self.hypocorisms.nicknames(first):
+            possible['nickname last'].append(f"{nickname} {last}")
 
-            return possible
+        return possible
 
 
@@ -18,7 +18,9 @@ Steps:
 """
 
 # import libraries
+import numpy as np
 import spacy
+from spacy.attrs import ENT_IOB, ENT_TYPE, ORTH, IDX, LENGTH
 from spacy.matcher import Matcher
 from collections import defaultdict
 from unionfind import unionfind
@@ -29,26 +31,127 @@ from typing import Tuple
 from src.data import make_dataset
 from src.features.char_id._gender_annotation import GenderAnnotation
 from src.features.char_id._occurrence_unification import OccurrenceUnification
+from src.features.char_id._merge_rules import apply_rules
+from src.features.char_id._cascade_ner import CascadeNER
+from src.features.char_id._mention_sweep import sweep_mentions
 from src.tools.character import Character, AllCharacters
-from src.models import mbank
+from src.models import mbank, mcreator
 from src.tools.character_grouping import CharacterGrouping
+from src.tools.data_based_name_parser import name_cache, GENDER_CODES
+from src.tools.position_index import PositionIndex
+
+
+def extract_person_mentions(doc, titles:set) -> tuple[list[str], np.ndarray]:
+    """
+    Find every PERSON entity of a doc from its token arrays, without iterating doc.ents.
+    If the token right before an entity is a title (with or without a period), the title is prepended to the name.
+
+    :param doc: spacy Doc with named entities
+    :param titles: set of titles without a period
+    :return: names (the title included) and token indices of the entity starts, in document order
+    """
+    if len(doc) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+
+    columns = doc.to_array([ENT_IOB, ENT_TYPE, ORTH, IDX, LENGTH]).astype(np.int64, copy=False)
+    iob, ent_type, orth, idx, length = columns.T
+    # ENT_IOB: 3 = B(egin), 1 = I(nside), 2 = O(utside), 0 = no tag
+    person = doc.vocab.strings["PERSON"]
+    starts = np.flatnonzero((iob == 3) & (ent_type == person))
+    # an entity ends right before the first token after its start that does not continue it
+    breaks = np.append(np.flatnonzero(iob != 1), len(doc))
+    ends = breaks[np.searchsorted(breaks, starts, side="right")]
+
+    # a title is the token before the entity whose text without periods is in the title set
+    title_hashes = np.array(
+        [doc.vocab.strings[t] for title in titles for t in (title, f"{title}.")], dtype=np.uint64
+    ).astype(np.int64)
+    prev = np.maximum(starts - 1, 0)
+    has_title = (starts > 0) & np.isin(orth[prev], title_hashes)
+
+    # slice the names out of the text by character offsets
+    text = doc.text
+    start_chars = np.where(has_title, idx[prev], idx[starts]).tolist()
+    title_ends = (idx[prev] + length[prev]).tolist()
+    name_starts = idx[starts].tolist()
+    end_chars = (idx[ends - 1] + length[ends - 1]).tolist()
+    names = [
+        f"{text[s:t]} {text[n:e]}" if titled else text[n:e]
+        for s, t, n, e, titled in zip(start_chars, title_ends, name_starts, end_chars, has_title.tolist())
+    ]
+    return names, starts
+
+
+def block_name_pairs(first_codes:np.ndarray, last_codes:np.ndarray, eligible:np.ndarray=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generate the candidate pairs of characters that share a first name or a surname, using an
+    inverted index from the name codes to character IDs instead of comparing every pair.
+    Empty parts (code -1) are not indexed, so they never make two characters candidates.
+
+    :param first_codes: first name code of each character ID
+    :param last_codes: surname code of each character ID
+    :param eligible: boolean mask of the IDs that may be paired (all IDs if None)
+    :return: two int arrays (left, right) of character IDs with left < right, without duplicates
+    """
+    if eligible is None:
+        eligible = np.ones(len(first_codes), dtype=bool)
+
+    # inverted index: (part, code) -> ascending character IDs
+    blocks = defaultdict(list)
+    for id in np.flatnonzero(eligible).tolist():
+        if first_codes[id] != -1:
+            blocks[(0, int(first_codes[id]))].append(id)
+        if last_codes[id] != -1:
+            blocks[(1, int(last_codes[id]))].append(id)
+
+    pairs = set()
+    for ids in blocks.values():
+        for i, left in enumerate(ids[:-1]):
+            for right in ids[i+1:]:
+                pairs.add((left, right))
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    left, right = np.array(sorted(pairs), dtype=np.int64).T
+    return left, right
 
 
 class CharacterIdentification:
-    def __init__(self, nlp, doc):
+    def __init__(self, nlp, doc, cascade:CascadeNER=None):
+        """
+        :param nlp: spacy Language object that parsed doc, or the name of a model in mcreator.pipelines
+        :param doc: spacy Doc, or a dictionary of Doc objects of the chunks of one long text
+            (see mcreator.create_spacy_docs). The occurrences of the characters are global token indices over
+            all the docs, i.e. the token index in a doc plus the token offset of that doc
+        :param cascade: CascadeNER that re-checks the uncertain sentences of the docs before detection,
+            when nlp is a fast (small) pipeline. It overwrites doc.ents of the docs in place.
+            The entities of nlp are used as they are if None
+        """
         # set format: {name: Character}
         self.chars = AllCharacters({})
         self.occurrences = None
-        self.nlp = nlp
+        # the configured pipeline shared by every stage in this process
+        self.nlp = mcreator.pipelines.get(nlp) if isinstance(nlp, str) else nlp
         self.doc = doc
+        self.docs = doc if isinstance(doc, dict) else {0: doc}
+        # global token offset of each doc in self.docs.values()
+        self.positions = PositionIndex(self.docs)
+        self.cascade = cascade
 
-    def run(self, verbose:bool=False) -> Tuple[dict[str: Character], list[list]]:
+    def run(self, verbose:bool=False, rules="strict", sweep:bool=False, referent_rules="loose") -> Tuple[dict[str: Character], list[list]]:
         """
+        :param rules: rule set used to merge names that share a first name or a surname
+        :param referent_rules: rule set used to filter the possible referents of each name
+            (see unify_occurrences)
+        :param sweep: after gender annotation, find the mentions of the detected names that the NER missed
+            (see sweep_mentions). They do not count toward the pronoun-based gender
         :return: a dictionary of character names (keys) and Character classes (values) and a list of co-occurrences
         """
         self.chars = self.detect_characters(self.chars)
         if verbose:
             msg.good("Character Detection is done\n")
+            if self.cascade is not None:
+                msg.info(f"Cascaded NER: {self.cascade.rechecked}/{self.cascade.sentences} sentences re-checked")
+            msg.info(f"Parsed name cache: {name_cache.cache_info()}")
             msg.good("="*50)
 
         self.chars = self.annotate_gender(self.chars, verbose=verbose)
@@ -56,7 +159,15 @@ class CharacterIdentification:
             msg.good("Gender Annotation is done\n")
             msg.good("=" * 50)
 
-        self.chars, self.occurrences = self.unify_occurrences(self.chars)
+        # after the gender annotation: the pronoun window starts at the end of an entity, and sweep matches are
+        # not entities
+        if sweep:
+            added = self.sweep_mentions(self.chars)
+            if verbose:
+                msg.good(f"Mention Sweep is done: {added} mentions added\n")
+                msg.good("=" * 50)
+
+        self.chars, self.occurrences = self.unify_occurrences(self.chars, rules=rules, referent_rules=referent_rules)
         if verbose:
             msg.good("Occurrence Unification is done\n")
             msg.good("=" * 50)
@@ -73,31 +184,30 @@ class CharacterIdentification:
         :return: a dictionary of character names (keys) and Character classes (values)
         """
 
-        female_titles, male_titles, common_titles = make_dataset.get_titles()
-        # merge all title sets with operator "|" (union)
-        titles = female_titles | male_titles | common_titles
-        for i, ent in enumerate(self.doc.ents):
-            if ent.label_ == "PERSON":
-                # in the set, we have {name: (gender, [**index])}
-                # ent is spacy.tokens.span.Span and has start attribute (index of the span in the doc)
-                name = ent.text
-
-                # identify a title if the name has one
-                if ent.start - 1 >= 0:
-                    title = self.doc[ent.start - 1].text
-                    if title.replace(".", "") in titles:
-                        name = f"{title} {name}"
-
-                # create a dictionary index if the name does not exist in the dict yet
-                # the name might have a title
-                if name not in chars.get_names():
-                    character = Character(name)
-                    chars.add_character(name, character)
-                    chars.assign_ids()
-                id = chars.name_to_id(name)
-                chars.append_occurence(id, ent.start)
+        # union of all title sets, cached by the lexicon
+        titles = make_dataset.lexicon.all_titles()
+
+        # (name, start) of every PERSON entity; the name might have a title
+        # start is the global index of the entity (without the title)
+        for doc, offset in zip(self.docs.values(), self.positions.doc_offsets.tolist()):
+            if self.cascade is not None:
+                # replace the entities of the uncertain sentences with those of the accurate pipeline
+                self.cascade(doc)
+            names, starts = extract_person_mentions(doc, titles)
+            chars.add_mentions(names, (starts + offset).tolist())
+
+        # replace the provisional IDs with stable, sorted ones now that every name is known
+        chars.assign_ids()
         return chars
 
+    def sweep_mentions(self, chars:AllCharacters) -> int:
+        """
+        (1') find the remaining exact mentions of the detected names, their first names and surnames, and their
+        hypocorisms with a PhraseMatcher, and append them to the occurrences with the source SOURCE_MATCHER
+        :return: number of mentions added
+        """
+        return sweep_mentions(self.nlp, chars, self.docs, self.positions.doc_offsets.tolist())
+
     def annotate_gender(self, chars: AllCharacters, verbose=False) -> AllCharacters:
         """
         (2) automatically anotate a gender to each entity based on:\n
@@ -117,51 +227,25 @@ class CharacterIdentification:
         if chars is None:
             raise ValueError(f"self.chars has not defined yet. Run detect_characters first.")
         # initialize the GenderAnnotation class upon defining self.char
-        ga = GenderAnnotation(self.nlp, self.doc, chars.chars)
+        ga = GenderAnnotation(self.nlp, self.doc, chars.chars, columns=chars.name_columns())
 
-        name_genders_title = ga.annotate_gender_by_titles_simple()
         if verbose:
+            name_genders_title = ga.annotate_gender_by_titles_simple()
             print(f"_annotate_gender_by_titles_simple: "
                   f"{name_genders_title}")
 
-        name_genders_name = ga.annotate_gender_by_names()
-        if verbose:
+            name_genders_name = ga.annotate_gender_by_names()
             print(f"_annotate_gender_by_names:"
                   f"{name_genders_name}")
         
-        # Dec/30/2024 - pronoun approach is quite unstable. We deprecate this for now.
-        # msg.warn("Dec/30/2024 - Pronoun approach is quite unstable. We deprecate this for now.")
-        # name_genders_pronoun = ga.annotate_gender_by_pronouns()
-        name_genders_pronoun = {name: "UNKNOWN" for name in chars.get_names()}
+        name_genders_pronoun = ga.annotate_gender_by_pronouns()
         if verbose:
             print(f"_annotate_gender_by_pronouns:"
                   f"{name_genders_pronoun}")
 
-        for name in chars.get_names():
-            gender_t = name_genders_title[name]
-            gender_n = name_genders_name[name]
-            gender_p = name_genders_pronoun[name]
-
-            genders = [gender_t, gender_n]
-            size = len(genders)
-            size -= genders.count("UNKNOWN")
-
-            # the pronoun approach is quite unstable
-            # use the pronoun approach only if the first two gender approaches cannot identify a gender
-
-            # if all the genders in the list are UNKNOWN
-            id = chars.name_to_id(name)
-            if size == 0:
-                chars.update_gender(id, gender_p)
-            # if all the specified genders in the list are FEMALE
-            elif genders.count("FEMALE") == size:
-                chars.update_gender(id, "FEMALE")
-            # if all the specified genders in the list are MALE
-            elif genders.count("MALE") == size:
-                chars.update_gender(id, "MALE")
-            # if the two of the elements are FEMALE and MALE or all undefined
-            else:
-                chars.update_gender(id, gender_p)
+        # the pronoun approach is quite unstable
+        # use the pronoun approach only if the title and the first name cannot identify a gender or they conflict
+        chars = ga.annotate(chars, pronoun_genders=name_genders_pronoun)
 
         if verbose:
             print(f"_annotate_gender_final:",
@@ -169,24 +253,18 @@ class CharacterIdentification:
             
         return chars
 
-    def _gender_matches(self, gender1, gender2):
-        genders = [gender1, gender2]
-        # if one of the two is unknown, count it as a gender match
-        if genders.count("UNKNOWN") >= 1:
-            return True
-        # if two of them are the same
-        elif genders.count("FEMALE") == 2 or genders.count("MALE") == 2:
-            return True
-        else:
-            return False
-
-    def unify_occurrences(self, chars:AllCharacters) -> list[list]:
+    def unify_occurrences(self, chars:AllCharacters, rules="strict", referent_rules="loose") -> list[list]:
         """
         Rules (https://aclanthology.org/D15-1088/)\n
         Two vertices cannot be merged if\n
         (1) the inferred genders of both names differ,\n
         (2) both names share a common surname but different first names, or\n
         (3) the title of both names differ, e.g., “Miss” and “Mrs.”\n
+        :param rules: name of a rule set in _merge_rules.RULE_SETS or a tuple of rule functions,
+            applied to names that share a first name or a surname
+        :param referent_rules: name of a rule set or a tuple of rule functions, applied to each name and its
+            possible referents (shorter forms and hypocorisms). "loose" by default, i.e. an UNKNOWN gender
+            matches any gender
         :return: list representation of networkX nodes/edges
         """
         if chars is None:
@@ -195,7 +273,9 @@ class CharacterIdentification:
             if char.gender == "GENDER UNDEFINED":
                 raise ValueError(f"annotate gender first by running annotate_gender method.")
 
-        ou = OccurrenceUnification(chars.chars)
+        # parsed names of all characters as arrays indexed by character ID
+        columns = chars.name_columns()
+        ou = OccurrenceUnification(chars.chars, columns=columns)
         referents = ou.unify_referents()
 
         # merge occurrences
@@ -214,27 +294,16 @@ class CharacterIdentification:
         
         del referents
 
-        # filter referents that do not meet gender or title consistency
-        to_remove = []
-        for name, refs in same_chars.items():
-            id = chars.name_to_id(name)
-            gender1 = chars.get_gender(id)
-            for ref in refs:
-                # if the characters' genders do not match, they are different characters
-                # UNKNOWNは許容する
-                ref_id = chars.name_to_id(ref)
-                gender2 = chars.get_gender(ref_id)
-                if not self._gender_matches(gender1, gender2):
-                    to_remove.append((name, ref))
-
-                # if both have a title, but they do not match, they are two separate characters
-                title1: str = chars.get_character_from_name(name).name_parsed.title
-                title2: str = chars.get_character_from_name(ref).name_parsed.title
-                if (title1 != '' and title2 != '') and (title1 != title2):
-                    to_remove.append((name, ref))
-                # otherwise, they are the same character
-        for name, ref in to_remove:
-            same_chars[name].discard(ref)
+        # filter referents that do not meet the referent rules (gender and title consistency by default)
+        genders = np.array([GENDER_CODES[chars.get_gender(id)] for id in range(len(columns))], dtype=np.int8)
+        pairs = [(name, ref) for name, refs in same_chars.items() for ref in refs]
+        if pairs:
+            left = np.array([chars.name_to_id(name) for name, _ in pairs], dtype=np.int64)
+            right = np.array([chars.name_to_id(ref) for _, ref in pairs], dtype=np.int64)
+            keep = apply_rules(referent_rules, columns, genders, left, right)
+            for (name, ref), kept in zip(pairs, keep.tolist()):
+                if not kept:
+                    same_chars[name].discard(ref)
 
         # if the same consistent referent exists in two separate characters' possible referent set,
         # prioritize the most frequent one (https://aclanthology.org/W14-0905/, https://aclanthology.org/E12-1065/)
@@ -259,7 +328,7 @@ class CharacterIdentification:
         for name, refs in same_chars.items():
             for ref in refs:
                 # if a referent is repeated, skip it
-                if ref in list(repeated_referents.keys()):
+                if ref in repeated_referents:
                     continue
                 char_groups.unite(name, ref)
 
@@ -285,48 +354,37 @@ class CharacterIdentification:
         # assign a name that potentially refers to different characters to the most frequent name too
         # Mr. Holmes -> Sherlock Holmes or Mycroft Holmes -> assign Sherlock as more frequent than Mycroft
         charlist = chars.get_names()
-        correspondence = defaultdict(list)
-
-        for i, char1 in enumerate(charlist[:-1]):
-            first1 = chars.get_character_from_name(char1).name_parsed.first
-            last1 = chars.get_character_from_name(char1).name_parsed.last
-            title1: str = chars.get_character_from_name(char1).name_parsed.title
-            l1 = [first1, last1, title1]
-            if l1.count('') >= 2:
-                continue
-
-            for char2 in charlist[i+1:]:
-                first2 = chars.get_character_from_name(char2).name_parsed.first
-                last2 = chars.get_character_from_name(char2).name_parsed.last
-                title2: str = chars.get_character_from_name(char2).name_parsed.title
-                l2 = [first2, last2, title2]
-                if l2.count('') >= 2:
-                    continue
-                
-                
-                # if the characters' genders do not match, they are different characters
-                if chars.get_gender(chars.name_to_id(char1)) != chars.get_gender(chars.name_to_id(char2)):
-                    continue
-                # if both have a title, but if the titles are different, they are two separate characters
-                elif (title1 != '' and title2 != '') and (title1 != title2):
-                    continue
-                elif first1 == first2 or last1 == last2:
-                    correspondence[char1].append(char2)
-                    correspondence[char2].append(char1)
+        # character IDs in the order of charlist, so that ties in frequency are broken by that order
+        char_ids = np.array([chars.name_to_id(name) for name in charlist], dtype=np.int64)
+        # number of missing parts among first, last and title of each character
+        missing = ((columns.first_code == -1).astype(int)
+                   + (columns.last_code == -1).astype(int)
+                   + (columns.title_code == -1).astype(int))[char_ids]
+
+        # only pairs sharing a first name or a surname can correspond
+        # the pairs are positions in charlist, sorted with i < j
+        i, j = block_name_pairs(columns.first_code[char_ids], columns.last_code[char_ids], missing < 2)
+        keep = apply_rules(rules, columns, genders, char_ids[i], char_ids[j])
+        i, j = i[keep], j[keep]
 
         # assign a referent that potentially refers to different characters to the most frequent name
         # Mr. Holmes -> Sherlock Holmes or Mycroft Holmes -> assign Mr. Holmes to Sherlock as more frequent than Mycroft
         # unite a consistent but repeated reference with the most frequent one
-        for char1, char2s in correspondence.items():
-            max_name = char2s[0]
-            max_occurrence = 0
-            # fetch refering names of each referent and get the char name of the maximum occurences
-            for name in char2s:
-                occ = len(chars.get_character_from_name(name).occurences)
-                if occ > max_occurrence:
-                    max_name = name
-                    max_occurrence = occ
-            char_groups.unite(char1, max_name)
+        if len(i) > 0:
+            occurrences = np.array([len(chars.get_character_from_id(id).occurences) for id in char_ids.tolist()])
+            # each pair in both directions: (name, corresponding name)
+            src = np.concatenate([i, j])
+            dst = np.concatenate([j, i])
+            # for each name, the most frequent corresponding name, the earliest one in charlist on a tie
+            order = np.lexsort((dst, -occurrences[dst], src))
+            names, first = np.unique(src[order], return_index=True)
+            targets = dst[order][first]
+            # unite in the order each name first appears among the pairs
+            appearance = np.column_stack([i, j]).ravel()
+            _, first_seen = np.unique(appearance, return_index=True)
+            target_of = dict(zip(names.tolist(), targets.tolist()))
+            for pos in appearance[np.sort(first_seen)].tolist():
+                char_groups.unite(charlist[pos], charlist[target_of[pos]])
 
         # reset the occurrence matrix as new characters were added to this AllCharacter instance
         chars.reset_occurences()
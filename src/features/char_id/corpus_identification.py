@@ -0,0 +1,97 @@
+"""
+Character identification over a whole corpus of stories.
+
+Each story of a corpus (e.g. the dictionary returned by make_dataset.format_ss or format_human_ss) is sent to a
+worker process, which parses it with its own spacy pipeline and runs detection, gender annotation and occurrence
+unification. The spacy pipeline is loaded once per worker, not once per story.
+Results stream back in the order of the corpus as soon as a story and all the stories before it are done.
+"""
+
+# import libraries
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Tuple
+
+# import local files
+from src.features.char_id.character_identification import CharacterIdentification
+from src.models import mcreator
+from src.tools.character import AllCharacters
+
+# state of the current worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(model:str, rules, save_model:bool, call_old_model:bool, stages=None, referent_rules="loose") -> None:
+    """
+    Load (and warm up) the spacy pipeline of a worker process
+    """
+    _worker["nlp"] = mcreator.pipelines.get(model, warmup=True, stages=stages)
+    _worker["model"] = model
+    _worker["rules"] = rules
+    _worker["referent_rules"] = referent_rules
+    _worker["save_model"] = save_model
+    _worker["call_old_model"] = call_old_model
+
+
+def _identify_story(story:Tuple[str, str]) -> Tuple[str, AllCharacters, list[list]]:
+    """
+    Run character identification on one story in a worker process
+
+    :param story: (title, text)
+    :return: (title, AllCharacters, groups of names of the same characters)
+    """
+    title, text = story
+    nlp, doc = mcreator.create_spacy_model(
+        title,
+        text,
+        model=_worker["model"],
+        save_model=_worker["save_model"],
+        call_old_model=_worker["call_old_model"],
+        nlp=_worker["nlp"],
+    )
+    ci = CharacterIdentification(nlp, doc)
+    chars, groups = ci.run(rules=_worker["rules"], referent_rules=_worker["referent_rules"])
+    return title, chars, groups
+
+
+def identify_corpus(
+        texts:dict[str, str],
+        model:str="en_core_web_trf",
+        n_workers:int=None,
+        rules="strict",
+        save_model:bool=False,
+        call_old_model:bool=False,
+        chunksize:int=1,
+        stages=None,
+        referent_rules="loose",
+        ) -> Iterator[Tuple[str, AllCharacters, list[list]]]:
+    """
+    Identify the characters of every story of a corpus over a process pool
+
+    :param texts: dictionary of titles and texts of the stories
+    :param model: name of the spacy pipeline loaded by every worker
+    :param n_workers: number of worker processes. os.cpu_count() if None; 1 runs in the current process
+    :param rules: rule set used to merge names (see CharacterIdentification.unify_occurrences)
+    :param save_model: save the Doc of each story (see mcreator.create_spacy_model)
+    :param call_old_model: reuse the saved Doc of each story if it exists
+    :param chunksize: number of stories sent to a worker at once
+    :param stages: lite mode: enable only the components these stages need, e.g. mcreator.LITE_STAGES
+        (see mcreator.load_spacy_model). The whole pipeline if None
+    :param referent_rules: rule set used to filter the possible referents of each name
+    :return: iterator of (title, AllCharacters, groups) in the order of texts
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers < 1:
+        raise ValueError(f"n_workers must be a positive integer, not {n_workers}.")
+    initargs = (model, rules, save_model, call_old_model, stages, referent_rules)
+
+    if n_workers == 1:
+        _init_worker(*initargs)
+        for story in texts.items():
+            yield _identify_story(story)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs) as executor:
+        # map keeps the order of the corpus and yields each result once it and the ones before it are done
+        yield from executor.map(_identify_story, texts.items(), chunksize=chunksize)
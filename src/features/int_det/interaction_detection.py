@@ -1,8 +1,10 @@
 # import libraries
 import spacy
+from spacy.attrs import IDX
 from spacy.tokens.doc import Doc
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 import math
+import numpy as np
 from collections import defaultdict
 from spacy.matcher import Matcher
 import json
@@ -15,9 +17,11 @@ from typing import List, Tuple, Dict, Any
 
 # import local files
 # from src.features.int_det import setup
+from src.models import mcreator
 from src.tools import narrative_units
 from src.tools.character import Character, AllCharacters
 from src.tools.path_tools import PathTools
+from src.tools.position_index import PositionIndex
 
 
 # Reference:
@@ -30,22 +34,27 @@ class InteractionDetection:
                  spacy_docs: dict[int: Doc],
                  chars: AllCharacters,
                  narrative_units: narrative_units.NarrativeUnits,
+                 positions: PositionIndex=None,
                  ) -> None:
         """
-        :param spacy_nlp: spacy.language.Language object of a text
+        :param spacy_nlp: spacy.language.Language object of a text, or the name of a model in mcreator.pipelines
         :param spacy_doc: spacy.tokens.doc.Doc object of a text
         :param unit_size_percentile: the relative sentence size of each narrative unit against the number of tokens of
         the whole text. The smaller the better, since the large unit size may overlook quick change in sentiment in the
         story.
         :param chars: a dictionary of character names and Character objects
+        :param positions: PositionIndex of spacy_docs. Taken from narrative_units (or built) if None
         """
 
         # self.ann = setup.initServer(text)
         self.title = title
-        self.nlps = spacy_nlp
+        self.nlps = mcreator.pipelines.get(spacy_nlp) if isinstance(spacy_nlp, str) else spacy_nlp
         self.docs = spacy_docs
         self.chars = chars
         self.narrative_units = narrative_units
+        if positions is None:
+            positions = narrative_units.positions if narrative_units is not None else PositionIndex(spacy_docs)
+        self.positions = positions
         self.conv_tracker = {}
 
         self.sentiment_analysis_ml_init = False
@@ -254,38 +263,35 @@ class InteractionDetection:
             pattern += f"{start}.*?{end}|"
         pattern = rf"({pattern})"
 
+        # the sentences of the doc come from the shared position index
+        try:
+            positions = self.positions
+            offset = positions.doc_offsets[positions.doc_position(doc)]
+        except ValueError:
+            positions = PositionIndex(doc)
+            offset = 0
+        token_chars = doc.to_array([IDX]).astype(np.int64, copy=False).reshape(-1)
+
         # すべてのマッチを見つける
-        re_matches = re.findall(pattern, doc.text)
-        num = 0
+        matches = [match for match in re.finditer(pattern, doc.text) if match.group() != ""]
         tracker = {}
-        for match in re_matches:
-            if match == "":
-                continue
+        for num, match in enumerate(matches):
             tracker[num] = dict()
-            tracker[num]["quote"] = match
-
-        done = []
-        for sent in list(doc.sents):
-            for i, match in tracker.items():
-                if i in done:
-                    continue
-                match = match["quote"]
-                if match not in sent.text:
-                    continue
-                quote_start, quote_end = None, None
-                for token in sent:
-                    if token.text == match[0] and quote_start is None:
-                        quote_start = token.i
-                    elif token.text == match[-1]:
-                        quote_end = token.i
-                tracker[i]["sent"] = sent
-                tracker[i]["sent start"] = sent.start
-                tracker[i]["sent end"] = sent.end
-                tracker[i]["quote start"] = quote_start
-                tracker[i]["quote end"] = quote_end
-                done.append(i)
-            if len(done) == len(tracker):
-                break
+            tracker[num]["quote"] = match.group()
+            if len(doc) == 0:
+                continue
+            # tokens of the opening and the closing quotation marks
+            quote_start, quote_end = (np.searchsorted(token_chars, [match.start(), match.end() - 1], side="right") - 1).tolist()
+            sent_id = int(positions.sentence_of(quote_start + offset))
+            # the whole quote has to be in one sentence
+            if positions.sentence_of(quote_end + offset) != sent_id:
+                continue
+            sent = positions.sentence(sent_id)
+            tracker[num]["sent"] = sent
+            tracker[num]["sent start"] = sent.start
+            tracker[num]["sent end"] = sent.end
+            tracker[num]["quote start"] = quote_start
+            tracker[num]["quote end"] = quote_end
         return tracker
     
     @PendingDeprecationWarning
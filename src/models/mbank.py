@@ -1,13 +1,26 @@
 
 # import
+import argparse
+import hashlib
+import json
+import mmap
 import pickle
+import time
+import uuid
+import spacy
 from src.tools.path_tools import PathTools
 from pathlib import Path
+from spacy.language import Language
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
 import os
 
 # initialize
 _pt = PathTools()
 
+# token attributes kept in the doc cache: text, tags, the parse, sentence boundaries, and named entities
+DOC_ATTRS = ("ORTH", "NORM", "LEMMA", "POS", "TAG", "MORPH", "DEP", "HEAD", "SENT_START", "ENT_IOB", "ENT_TYPE")
+
 # module
 def save_model(path, model) -> None:
     """
@@ -20,26 +33,260 @@ def save_model(path, model) -> None:
         pickle.dump(model, f)
 
 
-def get_spacy_doc_path(story_title:str, doc_type:str="trf") -> Path:
+def get_model(path):
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    return model
+
+
+def save_doc(path, doc:Doc, attrs=DOC_ATTRS) -> None:
     """
-    Concatenate a path to a spacy model directory and a given title of a story and return an absolute path to the pickle
-    :param story_title: title of story
-    :return: absolute path to the pickle file of the model of the story
+    Save a spacy Doc as DocBin bytes. Only the given token attributes and the user data (custom extensions)
+    are stored, not the vocab
+    :param path: path to the doc file
+    :param doc: spacy Doc to save
+    :param attrs: token attributes to store
+    :return: None
     """
-    root_path = f"models/spacy_nlp/spacy_doc_{doc_type}_{story_title}.pickle"
-    path = _pt.get_target_dir(root_path)
-    return path
+    doc_bin = DocBin(attrs=list(attrs), store_user_data=True, docs=[doc])
+    with open(path, 'wb') as f:
+        f.write(doc_bin.to_bytes())
 
 
-def get_model(path):
+def get_doc(path, vocab:Vocab, use_mmap:bool=False) -> Doc:
+    """
+    Load a spacy Doc saved by save_doc against the vocab of an already loaded pipeline
+    :param path: path to the doc file
+    :param vocab: vocab of the pipeline, e.g. nlp.vocab
+    :param use_mmap: read the file through a memory map instead of reading it into memory first
+    :return: spacy Doc
+    """
     with open(path, 'rb') as f:
-        model = pickle.load(f)
-    return model
+        if use_mmap:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                doc_bin = DocBin(store_user_data=True).from_bytes(data)
+        else:
+            doc_bin = DocBin(store_user_data=True).from_bytes(f.read())
+    return next(doc_bin.get_docs(vocab))
+
+
+def _pattern(finditer) -> str:
+    # the regex of a tokenizer function such as compile_infix_regex(...).finditer
+    return getattr(getattr(finditer, "__self__", None), "pattern", None)
+
+
+def pipeline_signature(nlp:Language) -> str:
+    """
+    Describe everything besides the text that changes a parse: the pipeline name and version,
+    its components, the spaCy version, and the tokenizer customizations (special cases and affix rules)
+    :param nlp: spacy Language object
+    :return: hex digest of the signature
+    """
+    tokenizer = nlp.tokenizer
+    signature = {
+        "pipeline": f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}",
+        "version": nlp.meta.get("version"),
+        "components": nlp.pipe_names,
+        "spacy": spacy.__version__,
+        "special_cases": getattr(tokenizer, "rules", None),
+        "prefix": _pattern(getattr(tokenizer, "prefix_search", None)),
+        "suffix": _pattern(getattr(tokenizer, "suffix_search", None)),
+        "infix": _pattern(getattr(tokenizer, "infix_finditer", None)),
+        "token_match": _pattern(getattr(tokenizer, "token_match", None)),
+        "url_match": _pattern(getattr(tokenizer, "url_match", None)),
+    }
+    dumped = json.dumps(signature, sort_keys=True, default=str)
+    return hashlib.sha256(dumped.encode("utf-8")).hexdigest()
+
+
+def doc_key(text:str, signature:str) -> str:
+    """
+    :param text: text to parse
+    :param signature: pipeline_signature of the pipeline that parses the text
+    :return: content-addressed key of the parsed doc
+    """
+    digest = hashlib.sha256(signature.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class DocCache:
+    """
+    Content-addressed cache of parsed docs. A doc is stored as a DocBin file named after doc_key, so an edited text
+    or a changed pipeline/tokenizer never reuses a stale parse.
+    There is no shared index, so any number of processes (e.g. the workers of identify_corpus) can use the same
+    directory: <key>.spacy holds the doc and its modification time is the last access time, and the sidecar
+    <key>.json holds the title and the creation time. Every file is written to a temporary file unique to the
+    process and moved into place, so a reader never sees a half-written file.
+    """
+    # age in seconds after which evict removes the temporary file of an interrupted write
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, directory:str="models/spacy_nlp/docs"):
+        """
+        :param directory: directory of the cache, from the root directory
+        """
+        self.directory = _pt.get_target_dir(directory)
+        # keys read with flush=False whose access time has not been written yet
+        self._accessed = {}
+
+    def path(self, key:str) -> Path:
+        return self.directory.joinpath(f"{key}.spacy")
+
+    def meta_path(self, key:str) -> Path:
+        return self.directory.joinpath(f"{key}.json")
+
+    def _tmp_path(self, path:Path) -> Path:
+        return path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+
+    def __contains__(self, key:str) -> bool:
+        return self.path(key).is_file()
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def entries(self) -> dict:
+        """
+        :return: {key: os.stat_result of the doc file} of every cached doc, read from the directory
+        """
+        entries = {}
+        if not self.directory.is_dir():
+            return entries
+        for path in self.directory.glob("*.spacy"):
+            try:
+                entries[path.stem] = path.stat()
+            except FileNotFoundError:
+                # removed by another process meanwhile
+                continue
+        return entries
+
+    def metadata(self, key:str) -> dict:
+        """
+        :return: title and creation time of a cached doc, or an empty dictionary if the sidecar is missing
+        """
+        try:
+            with open(self.meta_path(key), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key:str, vocab:Vocab, use_mmap:bool=False, flush:bool=True) -> Doc:
+        """
+        :param flush: write the access time right away; otherwise call flush later
+        :return: the cached doc, or None if the key is not cached
+        """
+        path = self.path(key)
+        try:
+            doc = get_doc(path, vocab, use_mmap=use_mmap)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if flush:
+            self._touch(key, now)
+        else:
+            self._accessed[key] = now
+        return doc
+
+    def _touch(self, key:str, now:float) -> None:
+        try:
+            os.utime(self.path(key), (now, now))
+        except FileNotFoundError:
+            # evicted meanwhile
+            pass
+
+    def flush(self) -> None:
+        """
+        Write the access times of the docs read with flush=False
+        """
+        for key, now in self._accessed.items():
+            self._touch(key, now)
+        self._accessed.clear()
+
+    def put(self, key:str, doc:Doc, title:str=None) -> None:
+        """
+        :param title: title of the story, kept in the sidecar for information
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp = self._tmp_path(path)
+        save_doc(tmp, doc)
+        os.replace(tmp, path)
+
+        meta_path = self.meta_path(key)
+        tmp = self._tmp_path(meta_path)
+        with open(tmp, "w") as f:
+            json.dump({"title": title, "created": time.time()}, f)
+        os.replace(tmp, meta_path)
+
+    def size(self) -> int:
+        """
+        :return: total size of the cached files in bytes
+        """
+        return sum(stat.st_size for stat in self.entries().values())
+
+    def _remove(self, path:Path) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self, max_bytes:int=None, max_entries:int=None) -> list[str]:
+        """
+        Remove the least recently used docs until the cache fits both limits.
+        Sidecars without a doc, temporary files of interrupted writes, and the index of older versions
+        are removed as well
+        :param max_bytes: maximum total size of the cached files. No limit if None
+        :param max_entries: maximum number of cached docs. No limit if None
+        :return: removed keys
+        """
+        self.flush()
+        entries = self.entries()
+        if not self.directory.is_dir():
+            return []
+
+        # files without a cached doc
+        now = time.time()
+        for path in self.directory.iterdir():
+            if path.suffix == ".json" and path.stem not in entries:
+                self._remove(path)
+            elif path.suffix == ".tmp":
+                try:
+                    if now - path.stat().st_mtime > self.STALE_TMP_SECONDS:
+                        self._remove(path)
+                except FileNotFoundError:
+                    pass
+
+        removed = []
+        size = sum(stat.st_size for stat in entries.values())
+        count = len(entries)
+        for key in sorted(entries, key=lambda k: entries[k].st_mtime):
+            if (max_bytes is None or size <= max_bytes) and (max_entries is None or count <= max_entries):
+                break
+            self._remove(self.path(key))
+            self._remove(self.meta_path(key))
+            size -= entries[key].st_size
+            count -= 1
+            removed.append(key)
+        return removed
+
+
+doc_cache = DocCache()
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the cache of parsed docs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("info", help="show the number and the total size of the cached docs")
+    evict = subparsers.add_parser("evict", help="remove the least recently used docs")
+    evict.add_argument("--max-mb", type=float, default=None, help="maximum total size in megabytes")
+    evict.add_argument("--max-entries", type=int, default=None, help="maximum number of cached docs")
+    args = parser.parse_args()
 
-def exists(path):
-    if type(path) is str:
-        path = Path(path)
-    parent_dir = path.parent
-    files = os.listdir(parent_dir)
-    return path.name in files
+    if args.command == "info":
+        print(f"{len(doc_cache)} docs, {doc_cache.size() / 2**20:.1f} MB in {doc_cache.directory}")
+    elif args.command == "evict":
+        max_bytes = None if args.max_mb is None else int(args.max_mb * 2**20)
+        removed = doc_cache.evict(max_bytes=max_bytes, max_entries=args.max_entries)
+        print(f"Removed {len(removed)} docs. {len(doc_cache)} docs, {doc_cache.size() / 2**20:.1f} MB left")
@@ -1,13 +1,155 @@
 import spacy
 from src.models import mbank
+from src.tools.position_index import get_positions
 from spacy.tokens import Doc
 from spacy.tokens import Span
 from spacy.tokens import Token
 from spacy.language import Language
 from wasabi import msg
 from pathlib import Path
+import re
+from typing import Iterable, Iterator, Tuple
 # from spacytextblob.spacytextblob import SpacyTextBlob
 
+# chapter markers such as [c1] or <c1>
+CHAPTER_MARKER = re.compile(r"\[c\d+\]|<c\d+>")
+
+
+# getters for paragraphs, read from the position index of the doc
+def _get_paragraphs(doc):
+    positions = get_positions(doc)
+    for start, end in zip(positions.para_starts.tolist(), positions.para_ends.tolist()):
+        yield doc[start:end]
+
+
+def _get_paragraph_id(token):
+    return int(get_positions(token.doc).para_ids[token.i])
+
+
+def set_extensions() -> None:
+    """
+    Add custom extensions to Doc and Token. Does nothing if they are already registered
+    """
+    # get_extension returns (default, method, getter, setter)
+    if not Doc.has_extension("paragraphs") or Doc.get_extension("paragraphs")[2] is not _get_paragraphs:
+        Doc.set_extension("paragraphs", force=True, getter=_get_paragraphs)
+    if not Token.has_extension("paragraph_id") or Token.get_extension("paragraph_id")[2] is not _get_paragraph_id:
+        Token.set_extension("paragraph_id", force=True, getter=_get_paragraph_id)
+
+
+# pipeline components each stage reads (besides the tokenizer and sentence boundaries)
+# None means the stage needs the whole pipeline
+STAGE_COMPONENTS = {
+    # character identification: PERSON entities
+    "characters": ("ner",),
+    # narrative units: sentence boundaries only
+    "units": (),
+    # conversation detection: dependency labels
+    "conversations": ("tok2vec", "tagger", "attribute_ruler", "parser"),
+    # coreference resolution
+    "coreference": None,
+}
+# stages of character identification and narrative units
+LITE_STAGES = ("characters", "units")
+
+
+def stage_components(nlp:Language, stages) -> list[str]:
+    """
+    :param nlp: spacy Language object
+    :param stages: names of stages in STAGE_COMPONENTS
+    :return: components of nlp the stages need, the shared embedding components they listen to included,
+        or None if the whole pipeline is needed
+    """
+    needed = set()
+    for stage in stages:
+        if stage not in STAGE_COMPONENTS:
+            raise ValueError(f"Unknown stage: {stage}. Choose from {list(STAGE_COMPONENTS.keys())}.")
+        if STAGE_COMPONENTS[stage] is None:
+            return None
+        needed.update(STAGE_COMPONENTS[stage])
+    needed &= set(nlp.pipe_names)
+    # a transformer or tok2vec component whose output a needed component listens to
+    for name, pipe in nlp.pipeline:
+        if needed & set(getattr(pipe, "listening_components", [])):
+            needed.add(name)
+    return [name for name in nlp.pipe_names if name in needed]
+
+
+def load_spacy_model(model="en_core_web_trf", stages=None) -> Language:
+    """
+    Load a spacy pipeline and configure its tokenizer for the chapter markers
+    :param model: name of the spacy pipeline
+    :param stages: lite mode: enable only the components these stages need (see STAGE_COMPONENTS),
+        with a rule-based sentencizer if the parser is disabled. The whole pipeline if None
+    :return: spacy Language object
+    """
+    nlp = spacy.load(model)
+
+    enable = stage_components(nlp, stages) if stages is not None else None
+    if enable is not None:
+        for name in nlp.pipe_names:
+            if name not in enable:
+                nlp.disable_pipe(name)
+        # sentence boundaries without the parser
+        if "parser" not in enable and "senter" not in enable:
+            nlp.add_pipe("sentencizer", first=True)
+
+    # add special cases for every chapter markers enclosed in square brackets: like [c1]
+    # this is to prevent the model from splitting the chapter markers into separate tokens
+    # Reference: https://stackoverflow.com/questions/76255486/how-to-stop-spacy-tokenizer-from-tokenizing-words-enclosed-within-brackets
+    # Add the special case rule
+    infixes = nlp.Defaults.infixes + [r"([\[\]])"]
+    nlp.tokenizer.infix_finditer = spacy.util.compile_infix_regex(infixes).finditer
+    tags = [f"c{chap}" for chap in range(1, 51)]
+    # Add the special cases to the tokenizer
+    for tag in tags:
+        nlp.tokenizer.add_special_case(f"[{tag}]", [{"ORTH": f"[{tag}]"}])
+    return nlp
+
+
+class PipelineFactory:
+    """
+    Loads and configures each spacy pipeline once per process.
+    Every stage asking for the same model gets the same Language object, so the model is loaded,
+    its tokenizer is configured, and the extensions are registered only once.
+    """
+    def __init__(self, warmup_text:str="Mr. Sherlock Holmes met Dr. Watson in London. He said hello to her."):
+        """
+        :param warmup_text: text parsed once by get(..., warmup=True)
+        """
+        self.warmup_text = warmup_text
+        self._pipelines = {}
+        self._warm = set()
+
+    def get(self, model:str="en_core_web_trf", warmup:bool=False, stages=None) -> Language:
+        """
+        :param model: name of the spacy pipeline
+        :param warmup: parse warmup_text once so that the first story does not pay for lazy initialization
+        :param stages: lite mode, see load_spacy_model. Each set of stages has its own Language object
+        :return: the configured Language object of the model
+        """
+        set_extensions()
+        key = (model, None if stages is None else frozenset(stages))
+        nlp = self._pipelines.get(key)
+        if nlp is None:
+            nlp = load_spacy_model(model, stages=stages)
+            self._pipelines[key] = nlp
+        if warmup and key not in self._warm:
+            nlp(self.warmup_text)
+            self._warm.add(key)
+        return nlp
+
+    def __contains__(self, model:str) -> bool:
+        return any(key[0] == model for key in self._pipelines)
+
+    def clear(self) -> None:
+        self._pipelines.clear()
+        self._warm.clear()
+
+
+pipelines = PipelineFactory()
+
+
 def create_spacy_model(
         title: str,
         text: str,
@@ -15,29 +157,20 @@ def create_spacy_model(
         save_model: bool = False,
         call_old_model: bool = False,
         verbose=False,
+        nlp: Language = None,
+        stages=None,
     ):
     """
     Create a spacy model and return it
     :param title: title of the story
     :param text: text of the story
     :param model: type of model to use
+    :param nlp: configured Language object. Taken from pipelines if None
+    :param stages: lite mode: stages the doc is made for (see STAGE_COMPONENTS). The whole pipeline if None
     :return:
     """
 
-    # set getter for paragraphs
-    def get_paragraphs(doc):
-        start = 0
-        for i, token in enumerate(doc):
-            if token.text.count("\n") >= 1 and i > 0:
-                # yield Span(self, start, token.i)
-                yield doc[start:token.i]
-                start = token.i + 1
-        yield doc[start:]
-        # yield Span(self, start, len(doc))
-
-    # Add custom extension to Doc and Token
-    Doc.set_extension("paragraphs", force=True, getter=get_paragraphs)
-    Token.set_extension("paragraph_id", default=None, force=True)
+    set_extensions()
 
     # add custom pipeline component to segment paragraphs
     # @Language.factory("paragraph_segmenter")
@@ -73,43 +206,196 @@ def create_spacy_model(
     #             token.is_sent_start = True
     #     return doc
 
-    nlp = spacy.load(model)
+    if nlp is None:
+        nlp = pipelines.get(model, stages=stages)
 
     # nlp.add_pipe("paragraph_segmenter")
     # nlp.add_pipe("custom_sentence_boundaries_quote", before="parser")
     # nlp.add_pipe("custom_sentence_boundaries_linebreak", before="parser")
 
-    # add special cases for every chapter markers enclosed in square brackets: like [c1]
-    # this is to prevent the model from splitting the chapter markers into separate tokens
-    # Reference: https://stackoverflow.com/questions/76255486/how-to-stop-spacy-tokenizer-from-tokenizing-words-enclosed-within-brackets
-    # Add the special case rule
-    infixes = nlp.Defaults.infixes + [r"([\[\]])"]
-    nlp.tokenizer.infix_finditer = spacy.util.compile_infix_regex(infixes).finditer
-    tags = [f"c{chap}" for chap in range(1, 51)]
-    # Add the special cases to the tokenizer
-    for tag in tags:
-        nlp.tokenizer.add_special_case(f"[{tag}]", [{"ORTH": f"[{tag}]"}])
-
     # load doc object
-    model_path = mbank.get_spacy_doc_path(title, doc_type=model.replace("en_core_web_", ""))
+    # cached docs are keyed by the text and the pipeline (tokenizer customizations included)
+    key = mbank.doc_key(text, mbank.pipeline_signature(nlp))
+    doc = mbank.doc_cache.get(key, nlp.vocab) if call_old_model is True else None
 
-    if mbank.exists(model_path) and call_old_model is True:
-        doc = mbank.get_model(model_path)
+    if doc is not None:
         if verbose:
-            msg.info('Pickled model exists. Copied the model.\n')
+            msg.info('Saved doc exists. Loaded the doc.\n')
         if save_model is True and verbose:
-            msg.info("Pickled model do not need to be saved.\n")
+            msg.info("Saved doc does not need to be saved.\n")
     else:
         if call_old_model is True and verbose:
-            msg.info("Pickled model don't exist. Couldn't copy a model.\n")
+            msg.info("Saved doc doesn't exist. Couldn't load a doc.\n")
         doc = nlp(text)
         if save_model is True:
-            mbank.save_model(model_path, doc)
+            mbank.doc_cache.put(key, doc, title=title)
             if verbose:
-                msg.info("Created a new model. Pickled model is saved.\n")
+                msg.info("Created a new doc. The doc is saved.\n")
         elif verbose:
-            msg.info("Did't create a new model. Pickled model is not saved.\n")
+            msg.info("Created a new doc. The doc is not saved.\n")
 
     return nlp, doc
 
 
+def create_spacy_models(
+        stories: Iterable[Tuple[str, str]],
+        model="en_core_web_trf",
+        save_model: bool = False,
+        call_old_model: bool = False,
+        verbose=False,
+        nlp: Language = None,
+        batch_size: int = 8,
+        n_process: int = 1,
+        use_mmap: bool = False,
+        stages=None,
+    ) -> Iterator[Tuple[str, Doc]]:
+    """
+    Corpus variant of create_spacy_model: parse many stories with nlp.pipe and yield their docs lazily
+    :param stories: iterable of (title, text)
+    :param model: type of model to use
+    :param save_model: save each doc as soon as it is parsed
+    :param call_old_model: reuse the saved doc of a story instead of parsing it
+    :param nlp: configured Language object. Taken from pipelines if None
+    :param batch_size: number of texts in each nlp.pipe batch
+    :param n_process: number of processes of nlp.pipe
+    :param use_mmap: read saved docs through a memory map
+    :param stages: lite mode: stages the docs are made for (see STAGE_COMPONENTS). The whole pipeline if None
+    :return: iterator of (title, doc) in the order of stories
+    """
+    set_extensions()
+    if nlp is None:
+        nlp = pipelines.get(model, stages=stages)
+    signature = mbank.pipeline_signature(nlp)
+
+    stories = iter(stories)
+    # the saved doc that ended the last run of unsaved stories: (title, doc)
+    stopped = []
+
+    def lookup(title:str, text:str) -> Tuple[str, Doc]:
+        key = mbank.doc_key(text, signature)
+        doc = mbank.doc_cache.get(key, nlp.vocab, use_mmap=use_mmap, flush=False) if call_old_model is True else None
+        if doc is not None and verbose:
+            msg.info(f"{title}: Saved doc exists. Loaded the doc.\n")
+        return key, doc
+
+    def run(first:tuple):
+        # a run of consecutive unsaved stories, ended by the next saved one (kept in stopped) or the last story
+        yield first
+        for title, text in stories:
+            key, doc = lookup(title, text)
+            if doc is not None:
+                stopped.append((title, doc))
+                return
+            yield text, (title, key)
+
+    # saved docs are yielded as soon as they are read; each run of unsaved stories goes through one nlp.pipe,
+    # so a fully saved corpus streams without parsing anything and a fresh corpus uses a single nlp.pipe
+    for title, text in stories:
+        key, doc = lookup(title, text)
+        if doc is not None:
+            yield title, doc
+            continue
+        for doc, (title, key) in nlp.pipe(run((text, (title, key))), as_tuples=True, batch_size=batch_size, n_process=n_process):
+            if save_model is True:
+                mbank.doc_cache.put(key, doc, title=title)
+                if verbose:
+                    msg.info(f"{title}: Created a new doc. The doc is saved.\n")
+            yield title, doc
+        if stopped:
+            yield stopped.pop()
+
+    # access times of the whole corpus at once
+    if call_old_model is True:
+        mbank.doc_cache.flush()
+
+
+def _split_paragraphs(text: str, max_length: int) -> list[str]:
+    """
+    Pack whole paragraphs (ending with a line break) into chunks of at most max_length characters.
+    A paragraph longer than max_length is cut at max_length
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > max_length:
+        # cut right after the last line break within max_length characters
+        cut = text.rfind("\n", start, start + max_length) + 1
+        if cut <= start:
+            cut = start + max_length
+        chunks.append(text[start:cut])
+        start = cut
+    chunks.append(text[start:])
+    return chunks
+
+
+def split_text(text: str, max_length: int) -> list[str]:
+    """
+    Split a text into chunks of at most max_length characters without losing any character.
+    A chunk starts at every chapter marker ([cN] or <cN>), and a chapter longer than max_length is split
+    at paragraph boundaries
+    :param text: text of the story
+    :param max_length: maximum number of characters of a chunk
+    :return: chunks whose concatenation is the text
+    """
+    if not text:
+        return [text]
+    bounds = [0] + [m.start() for m in CHAPTER_MARKER.finditer(text) if m.start() > 0] + [len(text)]
+    chunks = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        chunks.extend(_split_paragraphs(text[start:end], max_length))
+    return [chunk for chunk in chunks if chunk]
+
+
+def create_spacy_docs(
+        title: str,
+        text: str,
+        model="en_core_web_trf",
+        save_model: bool = False,
+        call_old_model: bool = False,
+        verbose=False,
+        nlp: Language = None,
+        max_length: int = None,
+        batch_size: int = 8,
+        n_process: int = 1,
+        stages=None,
+    ) -> Tuple[Language, dict[int, Doc], dict[int, int]]:
+    """
+    Create the docs of a text that may go over the Doc size limit: the text is split into chunks by split_text,
+    and the chunks are parsed in parallel with create_spacy_models
+    :param title: title of the story
+    :param text: text of the story
+    :param model: type of model to use
+    :param nlp: configured Language object. Taken from pipelines if None
+    :param max_length: maximum number of characters of a chunk. nlp.max_length if None
+    :param batch_size: number of chunks in each nlp.pipe batch
+    :param n_process: number of processes of nlp.pipe
+    :param stages: lite mode: stages the docs are made for (see STAGE_COMPONENTS). The whole pipeline if None
+    :return: nlp, dictionary of the docs of the chunks in text order,
+        and the global token index of the first token of each doc (the token offset of the chunk)
+    """
+    if nlp is None:
+        nlp = pipelines.get(model, stages=stages)
+    if max_length is None:
+        max_length = nlp.max_length
+    chunks = split_text(text, max_length)
+
+    # each chunk is cached as its own doc; a text in one chunk shares the cache entry of create_spacy_model
+    stories = [(f"{title}_{i}", chunk) for i, chunk in enumerate(chunks)]
+
+    docs = {}
+    offsets = {}
+    offset = 0
+    for i, (_, doc) in enumerate(create_spacy_models(
+            stories,
+            model=model,
+            save_model=save_model,
+            call_old_model=call_old_model,
+            verbose=verbose,
+            nlp=nlp,
+            batch_size=batch_size,
+            n_process=n_process,
+            stages=stages,
+    )):
+        docs[i] = doc
+        offsets[i] = offset
+        offset += len(doc)
+    return nlp, docs, offsets
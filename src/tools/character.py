@@ -1,23 +1,45 @@
 from nameparser import HumanName
-from src.tools.data_based_name_parser import NameParserChecker
+from src.tools.data_based_name_parser import NameParserChecker, ParsedNameColumns
+from array import array
 import numpy as np
+import sys
 from typing import Dict, Any, Tuple, List
 
+# source of an occurrence
+SOURCE_NER = 0      # a PERSON entity of the NER
+SOURCE_MATCHER = 1  # an exact mention found by the recall sweep (see _mention_sweep.py)
+
+
 class Character:
+    """
+    A character name with its parsed parts, gender, and the token indices of its occurrences.
+    Occurrences are stored in a compact int32 array, and the source of each occurrence in a parallel int8 array.
+    """
+    __slots__ = ("name", "name_parsed", "gender", "occurences", "sources", "id", "referent")
+
     def __init__(self, name:str):
-        self.name = name
+        self.name = sys.intern(name)
         self.name_parsed = NameParserChecker(name)
         self.gender = "GENDER UNDEFINED"
-        self.occurences = []
+        self.occurences = array('i')
+        self.sources = array('b')
         self.id = None
+        self.referent = None
 
         # self.possible_referents = self.getPossibleRerefents()
 
     def update_gender(self, gender):
         self.gender = gender
 
-    def append_occurences(self, start_idx:int):
+    def append_occurences(self, start_idx:int, source:int=SOURCE_NER):
         self.occurences.append(start_idx)
+        self.sources.append(source)
+
+    def occurences_from(self, source:int) -> list[int]:
+        """
+        :return: token indices of the occurrences found by the given source
+        """
+        return [idx for idx, s in zip(self.occurences, self.sources) if s == source]
 
     def __str__(self):
         return self.name
@@ -28,6 +50,7 @@ class Character:
             'name_parsed': self.name_parsed,
             'gender': self.gender,
             'occurences': self.occurences,
+            'sources': self.sources,
             'referent': self.referent,
             'id': self.id
         }
@@ -36,14 +59,54 @@ class Character:
     def update_referent(self, referent):
         self.referent = referent
 
+    def __reduce__(self):
+        # ship the occurrences as raw bytes and skip parsing the name again
+        return _restore_character, (
+            self.name, self.name_parsed, self.gender, self.occurences.tobytes(), self.id, self.referent,
+            self.sources.tobytes(),
+        )
+
+
+def _restore_character(name:str, name_parsed:NameParserChecker, gender:str, occurences:bytes, id:int, referent,
+                       sources:bytes=None) -> Character:
+    character = Character.__new__(Character)
+    character.name = sys.intern(name)
+    character.name_parsed = name_parsed
+    character.gender = gender
+    character.occurences = array('i')
+    character.occurences.frombytes(occurences)
+    character.sources = array('b')
+    if sources is None:
+        sources = bytes(len(character.occurences))
+    character.sources.frombytes(sources)
+    character.id = id
+    character.referent = referent
+    return character
+
 
 class AllCharacters:
+    """
+    Indexed registry of the characters in a story.
+    Membership tests and inserts take constant time: a new character gets a provisional ID in insertion order,
+    and assign_ids gives every character its stable (sorted by name) ID once all names are known.
+    The name -> ID and ID -> name maps are kept up to date on every insert.
+    Characters referring to the same person are stored as a label array (character ID -> group label,
+    the smallest ID of the group) with the member IDs of each group.
+    """
     def __init__(self, chars: dict[str: Character]):
         self.chars = chars
-        self.id_chars = {char.id: char for char in chars.values()}
-        self.occurences = np.zeros((len(chars), len(chars)), dtype=int) # one for same characters, zero for different characters
-        for i in range(len(chars)):
-            self.occurences[i, i] = 1
+        self._columns = None
+        if any(char.id is None for char in chars.values()):
+            self.assign_ids()
+        else:
+            self.update_id_chars()
+        self.reset_occurences()
+
+    def __getstate__(self) -> dict:
+        # the name columns are rebuilt on demand; do not pickle them
+        state = self.__dict__.copy()
+        state["_columns"] = None
+        return state
 
     def get_names(self) -> list[str]:
         """
@@ -51,16 +114,26 @@ class AllCharacters:
         """
         return list(self.chars.keys())
     
+    def __contains__(self, name:str) -> bool:
+        return name in self.chars
+
+    def __len__(self) -> int:
+        return len(self.chars)
+
     def update_id_chars(self) -> None:
         """
-        Update the internal id_chars dictionary
+        Update the internal id_chars dictionary and the name <-> ID maps from the IDs of the characters
         """
         self.id_chars = {char.id: char for char in self.chars.values()}
+        self._name_to_id = {name: char.id for name, char in self.chars.items()}
+        self._id_to_name = {char.id: name for name, char in self.chars.items()}
+        self._columns = None
         
 
     def assign_ids(self) -> None:
         """
-        Assign an ID to each character. Rewrites the ID if the character is already in the list
+        Assign an ID to each character. Rewrites the ID if the character is already in the list.
+        Call this once after all characters are added; until then, characters keep their provisional IDs
         """
 
         # apply sorting to save a consistent order
@@ -69,51 +142,116 @@ class AllCharacters:
             self.chars[name].id = id
             id += 1
         self.update_id_chars()
+        # the groups refer to the old IDs
+        self.reset_occurences()
     
     def id_to_name(self, id:int) -> str:
-        return self.id_chars[id].name
+        return self._id_to_name[id]
     
     def name_to_id(self, name:str) -> int:
-        return self.chars[name].id
+        return self._name_to_id[name]
     
     def add_character(self, name:int, character: Character) -> None:
+        """
+        Add a character in constant time. A new name gets the next provisional ID (in insertion order),
+        and a name already in the registry keeps its ID
+        """
+        id = self._name_to_id.get(name)
+        if id is None:
+            id = len(self._id_to_name)
+            self._name_to_id[name] = id
+            self._id_to_name[id] = name
+        character.id = id
         self.chars[name] = character
+        self.id_chars[id] = character
+        self._columns = None
+
+    def add_mentions(self, names:list[str], starts:list[int], source:int=SOURCE_NER) -> None:
+        """
+        Register a batch of mentions: unknown names become new characters and every start index is appended
+        to the occurrences of its name
+
+        :param names: names of the mentions
+        :param starts: token index of each mention, in the same order
+        :param source: source of the mentions, SOURCE_NER or SOURCE_MATCHER
+        """
+        for name, start in zip(names, starts):
+            character = self.chars.get(name)
+            if character is None:
+                character = Character(name)
+                self.add_character(name, character)
+            character.append_occurences(start, source)
+
+    def name_columns(self) -> ParsedNameColumns:
+        """
+        Get the parsed names of all characters as columns aligned to the character IDs,
+        i.e. element i of every column belongs to the character whose ID is i.
+        The columns are built once and rebuilt only after characters are added or IDs are reassigned.
+        """
+        if self._columns is None:
+            chars = [self.id_chars[id] for id in range(len(self.id_chars))]
+            self._columns = ParsedNameColumns(
+                [char.name for char in chars],
+                [char.name_parsed for char in chars],
+            )
+        return self._columns
     
-    def append_occurence(self, id:int, start_idx:int) -> None:
+    def append_occurence(self, id:int, start_idx:int, source:int=SOURCE_NER) -> None:
         name = self.id_to_name(id)
-        self.chars[name].append_occurences(start_idx)
+        self.chars[name].append_occurences(start_idx, source)
 
     def update_gender(self, id:int, gender:str) -> None:
         assert gender in ["MALE", "FEMALE", "UNKNOWN"], gender
         name = self.id_to_name(id)
         self.chars[name].update_gender(gender)
 
+    def _grow_labels(self) -> None:
+        """
+        Give each character added since the last reset its own group
+        """
+        n = len(self.labels)
+        if n < len(self.chars):
+            self.labels = np.concatenate([self.labels, np.arange(n, len(self.chars), dtype=np.int32)])
+            self.members.update({id: [id] for id in range(n, len(self.chars))})
+
     def update_occurences_from_list(self, same_chars:list[int]) -> None:
         """
-        Update the occurences matrix with the same characters
+        Merge the groups of the given characters into one group
 
         :param same_chars: list of IDs of the same characters
         """
-        grid = np.ix_(same_chars, same_chars)
-        self.occurences[grid] = 1
+        self._grow_labels()
+        labels = {int(self.labels[id]) for id in same_chars}
+        if len(labels) <= 1:
+            return
+        label = min(labels)
+        ids = sorted(id for l in labels for id in self.members.pop(l))
+        self.labels[ids] = label
+        self.members[label] = ids
 
-    def get_occurences(self) -> int:
+    def get_occurences(self) -> np.ndarray:
         """
-        Get the number of occurences between two characters
+        Get the dense matrix of the groups, built on demand
 
-        :param name1: name of the first character
-        :param name2: name of the second character
-        :return: number of occurences between the two characters
+        :return: N x N matrix, one for the same characters and zero for different characters
         """
-        return self.occurences
-    
+        self._grow_labels()
+        return (self.labels[:, None] == self.labels[None, :]).astype(int)
+
+    def groups(self) -> list[list[int]]:
+        """
+        Get the IDs of the same characters, one sorted list per group, ordered by their smallest ID
+        """
+        self._grow_labels()
+        return [self.members[label] for label in sorted(self.members)]
+
     def reset_occurences(self) -> None:
-        self.occurences = np.zeros((len(self.chars), len(self.chars)), dtype=int)
-        for i in range(len(self.chars)):
-            self.occurences[i, i] = 1
+        self.labels = np.arange(len(self.chars), dtype=np.int32)
+        self.members = {id: [id] for id in range(len(self.chars))}
     
     def is_same_character(self, id1:int, id2:int) -> bool:
-        return self.occurences[id1, id2] == 1
+        self._grow_labels()
+        return self.labels[id1] == self.labels[id2]
 
     def get_character_from_name(self, name:str) -> Character:
         return self.chars[name]
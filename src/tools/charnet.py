@@ -150,13 +150,7 @@ def merge_charnet_occurences(graph: CharNet) -> nx.Graph:
     Merge all occurrences of the same character into one node
     :return: merged graph
     """
-    occurences: np.ndarray = graph.meta_chars.occurences
-    idxs = np.where(occurences == 1)
-    idxs = list()
-    for i in range(occurences.shape[0]):
-        idx = sorted(list(np.where(occurences[i]==1)[0]))
-        idxs.append(idx) if idx not in idxs else None
-    # idxs = [list(map(int, mulidx)) for mulidx in zip(*idxs)]
+    idxs = graph.meta_chars.groups()
     for same_char_ids in idxs:
         # get the most used reference in the story as a representative of the character
         max_occ = 0
@@ -1,5 +1,6 @@
 try:
     from src.data import make_dataset
+    from src.tools.path_tools import PathTools
 except:
     import sys
     from path_tools import PathTools
@@ -7,51 +8,201 @@ except:
     sys.path.append(str(pt.get_root_dir()))
     from src.data import make_dataset
 from nameparser import HumanName as _HumanName
+from collections import OrderedDict, namedtuple
+import numpy as np
+import os
+import pickle
+import sys
 
+_pt = PathTools()
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class ParsedNameCache:
+    """
+    Bounded LRU cache of corrected name dictionaries keyed by the raw name string.
+    One instance (name_cache) is shared by every NameParserChecker in the process,
+    so a name like "Mr. Holmes" is parsed once no matter how many stories it appears in.
+    The cache is emptied when a source file of the lexicon it was computed with changes: every lookup runs the
+    (throttled, see Lexicon.check) freshness check of the lexicon, so a cache hit never serves a stale parse.
+    """
+    def __init__(self, maxsize:int=8192, path:str="models/name_parser_cache.pickle"):
+        """
+        :param maxsize: maximum number of names to keep. None for no limit
+        :param path: default path of the pickle file used by save and load, from the root directory
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generation = make_dataset.lexicon.generation
+
+    def _check_generation(self) -> None:
+        generation = make_dataset.lexicon.check()
+        if self._generation != generation:
+            self._data.clear()
+            self._generation = generation
+
+    def get(self, name:str):
+        """
+        :return: (dictionary of the name parts, first name, last name) with a copy of the dictionary,
+        or None on a miss
+        """
+        self._check_generation()
+        parsed = self._data.get(name)
+        if parsed is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(name)
+        self.hits += 1
+        name_parsed, first, last = parsed
+        return dict(name_parsed), first, last
+
+    def put(self, name:str, parsed:tuple) -> None:
+        """
+        :param parsed: (dictionary of the name parts, first name, last name) as returned by NameParserChecker.parse
+        """
+        self._check_generation()
+        name_parsed, first, last = parsed
+        self._data[name] = (dict(name_parsed), first, last)
+        self._data.move_to_end(name)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def clear(self) -> None:
+        """
+        Empty the cache and reset the counters
+        """
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _source_mtimes(self) -> dict:
+        return {
+            source: os.stat(_pt.get_target_dir(source)).st_mtime_ns for source in make_dataset.get_lexicon_sources()
+        }
+
+    def save(self, path:str=None) -> None:
+        """
+        Pickle the cached names together with the modification times of the lexicon files they were parsed with
+        :param path: path from the root directory. Defaults to self.path
+        """
+        path = _pt.get_target_dir(path or self.path)
+        with open(path, 'wb') as f:
+            pickle.dump({"sources": self._source_mtimes(), "names": list(self._data.items())}, f)
+
+    def load(self, path:str=None) -> bool:
+        """
+        Add the names pickled by save to the cache.
+        Nothing is loaded if the file does not exist or the lexicon files have changed since it was saved.
+        :param path: path from the root directory. Defaults to self.path
+        :return: whether the names were loaded
+        """
+        path = _pt.get_target_dir(path or self.path)
+        if not path.exists():
+            return False
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved["sources"] != self._source_mtimes():
+            return False
+        for name, parsed in saved["names"]:
+            self.put(name, parsed)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# the cache shared by every NameParserChecker in the process
+name_cache = ParsedNameCache()
+
+
+# keys of the dictionaries made by nameparser, in their order
+NAME_PARTS = tuple(_HumanName().as_dict().keys())
+_TITLE, _MIDDLE, _SUFFIX, _NICKNAME = (NAME_PARTS.index(p) for p in ("title", "middle", "suffix", "nickname"))
 
 
 class NameParserChecker:
     """
     This class compensates nameparser's misidentifications of last name and first name
-    by refering to a set of first names and last names
+    by refering to a set of first names and last names.
+    The corrected parts are kept as a tuple of interned strings (in the order of NAME_PARTS) instead of a dictionary,
+    so that thousands of parsed names share their strings and pickle cheaply.
     """
-    def __init__(self, name):
+    __slots__ = ("name", "_parts", "first", "last")
+
+    def __init__(self, name, use_cache:bool=True):
+        """
+        :param name: raw name string
+        :param use_cache: look the name up in (and add it to) the process-wide name_cache
+        """
         self.name = name
-        self._name_parsed = _HumanName(name).as_dict()
-        first, f_pos = self.check_first(self._name_parsed)
-        last, l_pos = self.check_last(self._name_parsed)
+        parsed = name_cache.get(name) if use_cache else None
+        if parsed is None:
+            parsed = self.parse(name)
+            if use_cache:
+                name_cache.put(name, parsed)
+        name_parsed, first, last = parsed
+        self._parts = tuple(sys.intern(name_parsed[p]) for p in NAME_PARTS)
+        self.first = sys.intern(first)
+        self.last = sys.intern(last)
+
+    # corrected name components
+    @property
+    def title(self) -> str:
+        return self._parts[_TITLE]
+
+    @property
+    def middle(self) -> str:
+        return self._parts[_MIDDLE]
+
+    @property
+    def suffix(self) -> str:
+        return self._parts[_SUFFIX]
+
+    @property
+    def nickname(self) -> str:
+        return self._parts[_NICKNAME]
+
+    def parse(self, name) -> tuple[dict, str, str]:
+        """
+        :param name: raw name string
+        :return: dictionary of the name parts corrected with the name lists, first name, and last name.
+        The first and last names are taken before redundant parts are blanked in the dictionary,
+        so they may differ from the dictionary (e.g. "Holmes" has "Holmes" as both first and last name)
+        """
+        name_parsed = _HumanName(name).as_dict()
+        first, f_pos = self.check_first(name_parsed)
+        last, l_pos = self.check_last(name_parsed)
 
         # overwrite name_parsed with correct parts of the name
         if first:
-            self.first = first
-            self._name_parsed['first'] = first
+            name_parsed['first'] = first
 
             # delete an element if the element in the original position is the same as the first name
             # this is for deleting redundancy in a case where only either a first or last name is specified
-            if f_pos and first == self._name_parsed[f_pos]:
-                self._name_parsed[f_pos] = ''
+            if f_pos and first == name_parsed[f_pos]:
+                name_parsed[f_pos] = ''
         else:
-            self.first = ''
-            self._name_parsed['first'] = ''
+            name_parsed['first'] = ''
 
         if last:
-            self.last = last
-            self._name_parsed['last'] = last
+            name_parsed['last'] = last
             # delete an element if the element in the original position is the same as the first name
             # this is for deleting redundancy in a case where only either a first or last name is specified
             # if the original position is overwritten in the first name phase,
             # this statement does not make any changes in the dictionary
-            if l_pos and last == self._name_parsed[l_pos]:
-                self._name_parsed[l_pos] = ''
+            if l_pos and last == name_parsed[l_pos]:
+                name_parsed[l_pos] = ''
         else:
-            self.last = ''
-            self._name_parsed['last'] = ''
-
-        # create instances of corrected name components
-        self.middle = self._name_parsed['middle']
-        self.suffix = self._name_parsed['suffix']
-        self.nickname = self._name_parsed['nickname']
-        self.title = self._name_parsed['title']
+            name_parsed['last'] = ''
+        return name_parsed, first or '', last or ''
 
     def check_first(self, name_parsed):
         """
@@ -59,8 +210,9 @@ class NameParserChecker:
         :return: correct first name and the position that the first name was classified into
         """
 
-        female_names, male_names = make_dataset.get_namelists()
-        hypocorisms = set(make_dataset.get_hypocorisms(nicknames_for_names=True).keys())
+        female_names, male_names = make_dataset.lexicon.namelists()
+        # known names and hypocorisms in both directions
+        hypocorisms = make_dataset.lexicon.hypocorism_index()
         first = name_parsed['first']
         if first in female_names or first in male_names or first in hypocorisms:
             # if the parsed name object has a correct first name or nickname (like Em), return the first name
@@ -93,7 +245,7 @@ class NameParserChecker:
             :param name_parsed: dictionary
             :return: correct last name and the position that the last name was classified into
         """
-        surnames = make_dataset.get_surnames()
+        surnames = make_dataset.lexicon.surnames()
         last = name_parsed['last']
         if last in surnames:
             return last, None
@@ -116,11 +268,84 @@ class NameParserChecker:
         return last, None
 
     def as_dict(self):
-        return self._name_parsed
+        return dict(zip(NAME_PARTS, self._parts))
 
     def __str__(self):
         return str(self.name)
 
+    def __reduce__(self):
+        # rebuild from the parts without parsing the name again
+        return _restore_name_parser_checker, (self.name, self._parts, self.first, self.last)
+
+
+def _restore_name_parser_checker(name:str, parts:tuple, first:str, last:str) -> NameParserChecker:
+    checker = NameParserChecker.__new__(NameParserChecker)
+    checker.name = name
+    checker._parts = tuple(sys.intern(p) for p in parts)
+    checker.first = sys.intern(first)
+    checker.last = sys.intern(last)
+    return checker
+
+
+# integer codes of the gender columns
+GENDERS = make_dataset.GENDERS
+GENDER_CODES = make_dataset.GENDER_CODES
+
+
+def _factorize(values:list[str]) -> np.ndarray:
+    """
+    :return: integer code of each value; equal strings share a code and the empty string is -1
+    """
+    codes = {}
+    return np.array([codes.setdefault(v, len(codes)) if v != '' else -1 for v in values], dtype=np.int32)
+
+
+class ParsedNameColumns:
+    """
+    Columnar representation of a list of parsed names.
+    Every attribute is a numpy array aligned to self.names (i.e. to the character IDs when built by AllCharacters).
+    String columns use '' for a missing part, code columns use -1 for it,
+    and gender columns use GENDER_CODES (0: UNKNOWN, 1: MALE, 2: FEMALE).
+    """
+    def __init__(self, names:list[str], parsed:list[NameParserChecker]):
+        """
+        :param names: raw names
+        :param parsed: NameParserChecker of each name, in the same order
+        """
+        gender_table = make_dataset.lexicon.gender_table()
+
+        first = [p.first for p in parsed]
+        last = [p.last for p in parsed]
+        middle = [p.middle for p in parsed]
+        title = [p.title for p in parsed]
+
+        self.names = list(names)
+        self.first = np.array(first, dtype=object)
+        self.last = np.array(last, dtype=object)
+        self.middle = np.array(middle, dtype=object)
+        self.title = np.array(title, dtype=object)
+
+        # equal strings share the same code, so the stages can compare name parts as integers
+        self.first_code = _factorize(first)
+        self.last_code = _factorize(last)
+        self.title_code = _factorize(title)
+
+        # one lookup in the gender table per name part
+        self.title_gender = np.array([gender_table.title_gender(t) for t in title], dtype=np.int8)
+        self.first_gender = np.array([gender_table.name_gender(f) for f in first], dtype=np.int8)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+def parse_names(names:list[str]) -> ParsedNameColumns:
+    """
+    Parse a list of names at once (through the shared name_cache) and return them as columns
+    :param names: raw names
+    :return: ParsedNameColumns aligned to the order of names
+    """
+    return ParsedNameColumns(names, [NameParserChecker(name) for name in names])
+
 
 if __name__ == '__main__':
     # test the performance
@@ -1,9 +1,104 @@
 from collections import defaultdict
+from collections.abc import MutableMapping
+from spacy.attrs import IDX
 from spacy.tokens import Doc
 from src.tools.character import Character, AllCharacters
+from src.tools.position_index import PositionIndex
 import math
+import numpy as np
 from typing import Any, Dict
 
+class NarrativeUnitBuilder:
+    """
+    The arrays every partition of a story into narrative units needs: sentence boundaries, the character offset
+    of each boundary, and the occurrences of all characters sorted by token index.
+    They are computed once, and units returns the partition for any unit size as a NarrativeUnits view over them,
+    so sweeping the granularity (e.g. percentiles 0.01, 0.02, 0.05, 0.1) does not rebuild the story each time.
+    """
+    def __init__(self, title:str, docs:dict[int: Doc], chars:AllCharacters, positions:PositionIndex=None) -> None:
+        """
+        :param title: title of the story
+        :param docs: dictionary of Doc objects
+        :param chars: AllCharacters object with the occurrences of the characters
+        :param positions: PositionIndex of docs. Built from docs if None
+        """
+        self.title = title
+        self.docs = docs
+        self.chars = chars
+        # token positions shared with the other stages
+        self.positions = PositionIndex(docs) if positions is None else positions
+
+        # global token index of every sentence start, and the end of the story
+        self.sent_bounds = np.append(self.positions.sent_starts, len(self.positions))
+        # character offset of each bound in its doc; the end of the story is the length of the last doc
+        token_chars = [doc.to_array([IDX]).astype(np.int64, copy=False).reshape(-1) for doc in self.positions.docs]
+        last_doc = self.positions.docs[-1] if self.positions.docs else None
+        token_chars.append(np.array([len(last_doc.text) if last_doc is not None else 0], dtype=np.int64))
+        self.sent_chars = np.concatenate(token_chars)[self.sent_bounds]
+
+        # occurrences of every character sorted by token index, with the position of their character
+        self.chars_list = chars.get_all_characters()
+        occurrences = [np.frombuffer(char.occurences, dtype=np.int32) for char in self.chars_list]
+        owners = np.repeat(np.arange(len(self.chars_list)), [len(o) for o in occurrences])
+        occurrences = np.concatenate(occurrences or [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        order = np.argsort(occurrences, kind="stable")
+        self.occurrences = occurrences[order]
+        self.owners = owners[order]
+
+    @property
+    def n_sents(self) -> int:
+        return self.positions.n_sents
+
+    def sentences_per_unit(self, unit_percentile:float) -> int:
+        """
+        :return: number of sentences of each unit for a percentage of the total number of sentences
+        """
+        return math.ceil(self.n_sents * unit_percentile)
+
+    def units(self, unit_percentile:float=None, unit_sent_num:int=None) -> "NarrativeUnits":
+        """
+        :param unit_percentile: the percentage of the total number of sentences that each narrative unit should have
+        :param unit_sent_num: the number of sentences of each narrative unit, instead of unit_percentile
+        :return: NarrativeUnits sharing the arrays of this builder
+        """
+        return NarrativeUnits(
+            self.title, self.docs, self.chars,
+            unit_percentile=unit_percentile, unit_sent_num=unit_sent_num, builder=self,
+        )
+
+    def by_percentiles(self, percentiles:list[float]) -> dict[float, "NarrativeUnits"]:
+        """
+        :return: {percentile: NarrativeUnits}
+        """
+        return {p: self.units(unit_percentile=p) for p in percentiles}
+
+    def by_sentence_counts(self, counts:list[int]) -> dict[int, "NarrativeUnits"]:
+        """
+        :return: {number of sentences per unit: NarrativeUnits}
+        """
+        return {n: self.units(unit_sent_num=n) for n in counts}
+
+    def span_text(self, start:int, end:int) -> str:
+        """
+        Materialize the text of a global token span [start, end) from the docs; the parts in different docs
+        are joined with a space
+
+        :param start: first global token index
+        :param end: global token index after the last token
+        :return: text of the span
+        """
+        if end <= start:
+            return ""
+        offsets = self.positions.doc_offsets
+        parts = []
+        for k in range(int(self.positions.doc_of(start)), int(self.positions.doc_of(end - 1)) + 1):
+            doc = self.positions.docs[k]
+            s = max(start - int(offsets[k]), 0)
+            e = min(end - int(offsets[k]), len(doc))
+            parts.append(doc[s:e].text)
+        return " ".join(parts)
+
+
 class NarrativeUnits:
     def __init__(
             self,
@@ -11,13 +106,23 @@ class NarrativeUnits:
             docs:dict[int: Doc],
             chars: AllCharacters,
             unit_percentile:float=0.02,
+            positions:PositionIndex=None,
+            unit_sent_num:int=None,
+            builder:NarrativeUnitBuilder=None,
             ) -> None:
         """
-        Creates a dictionary-based class for narrative units
+        Creates a dictionary-based class for narrative units.
+        Each unit is the half-open token span [start, end) of a run of sentences, with start_char the character
+        offset of its start in its doc. Neither the text nor the characters of a unit are copied; get_text slices
+        the text from the docs and the characters are a slice of the sorted occurrences
 
         :param docs: dictionary of Doc objects. Sometimes a text goes over the Doc size limit.
         :param title: title of the story
         :param unit_percentile: the percentage of the total number of sentences that each narrative unit should have
+        :param positions: PositionIndex of docs. Built from docs if None
+        :param unit_sent_num: the number of sentences of each narrative unit, instead of unit_percentile
+        :param builder: NarrativeUnitBuilder whose arrays this partition shares (see NarrativeUnitBuilder.units).
+            Built from docs if None, and the units are then registered in the PositionIndex
         """
 
 
@@ -27,84 +132,57 @@ class NarrativeUnits:
         self.chars = chars
         self.unit_percentile = unit_percentile
 
+        register = builder is None
+        if builder is None:
+            builder = NarrativeUnitBuilder(title, docs, chars, positions)
+        self.builder = builder
+        self.positions = builder.positions
 
-        # Push chars in ascending order based on their token index
-        idxs = [(idx, char) for char in chars.get_all_characters() for idx in char.occurences]
-        idxs = sorted(idxs, key=lambda x: x[0], reverse=False)
+        # calculate the number of sentences for each narrative unit
+        all_sent_num = builder.n_sents
+        if unit_sent_num is None:
+            unit_sent_num = builder.sentences_per_unit(unit_percentile)
+        elif unit_sent_num < 1:
+            raise ValueError(f"unit_sent_num must be a positive integer, not {unit_sent_num}.")
+        self.unit_sent_num = unit_sent_num
+        # number of units with exactly unit_sent_num sentences; the remaining sentences make the last unit
+        full_unit_num = all_sent_num // unit_sent_num if unit_sent_num > 0 else 0
 
+        # first sentence of each unit, the last unit included (it may have no sentence)
+        unit_sents = np.arange(full_unit_num + 1) * unit_sent_num
+        starts = builder.sent_bounds[unit_sents]
+        ends = np.append(starts[1:], len(self.positions))
+        if register:
+            self.positions.set_units(starts)
 
+        # each unit is the half-open token span [start, end) with the character offset of its start in its doc
+        self.spans = np.stack([starts, ends, builder.sent_chars[unit_sents]], axis=1)
+        # the occurrences of the k-th unit are builder.occurrences[occurrence_bounds[k]:occurrence_bounds[k + 1]]
+        self.occurrence_bounds = np.append(
+            np.searchsorted(builder.occurrences, starts, side="left"), len(builder.occurrences)
+        )
+        self.occurrence_bounds[0] = 0
 
-        # calculate the total number of tokens in the text
-        all_sent_num = 0
-        for doc in docs.values():
-            all_sent_num += len(list(doc.sents))
-        # calculate the number of sentences for each narrative unit
-        each_unit_sent_num = math.ceil(all_sent_num * unit_percentile)
-
-        # index of each narrative unit
-        unit_idx = 0
-        # separate token index is necessary to keep track of the number of tokens across different Doc objects
-        sent_idx = 0
-        # token index for character occurences
-        token_idx = 0
-        # string object that stores the actual text of each narrative unit
-        narrative = ''
-        pointer = 0
-
-        # start and end index of each narrative unit
-        start = 0
-        end = 0
-        
-        characters = []
-        for doc in docs.values():
-            doc: Doc
-            for sent in doc.sents:
-                sent_idx += 1
-                token_idx += len(sent)
-                narrative += sent.text + " "
-
-                if sent_idx == each_unit_sent_num:
-                    end = token_idx
-                    # add the narrative-unit text to the dictionary
-                    self.update_text(unit_idx, narrative)
-
-                    # check which characters are in the unit
-                    done = False
-                    while not done:
-                        # idx, char = idxs[pointer]
-                        
-                        if pointer == len(idxs):    # otherwise, pointer will be out of range
-                            done = True
-                            continue
-                        idx, char = idxs[pointer]
-                        # if token idx of the character is less than the current token idx
-                        if idx <= token_idx:
-                            characters.append(char)
-                            pointer += 1
-                        elif idx > token_idx:
-                            done = True
-                    self.add_property(unit_idx, "characters", characters)
-                    self.add_property(unit_idx, "start", start)
-                    self.add_property(unit_idx, "end", end)
-
-                    characters = []
-                    narrative = ""
-                    unit_idx += 1
-                    sent_idx = 0
-                    start = token_idx 
-        # add the last remaining sentences to the dictionary
-        self.update_text(unit_idx, narrative)
-        characters = [char for idx, char in idxs[pointer:]]
-        end = token_idx
-
-        self.add_property(unit_idx, "characters", characters)
-        self.add_property(unit_idx, "start", start)
-        self.add_property(unit_idx, "end", end)
+        for unit_idx, (start, end, start_char) in enumerate(self.spans.tolist()):
+            self.units[unit_idx] = _Unit(self, unit_idx)
+            self.add_property(unit_idx, "start", start)
+            self.add_property(unit_idx, "end", end)
+            self.add_property(unit_idx, "start_char", start_char)
+
+    def get_characters(self, unit_idx:int) -> list[Character]:
+        """
+        Get the characters occurring in the narrative unit, once per occurrence in the order of the occurrences
 
+        :param unit_idx: index of the narrative unit
+        :return: list of Character objects
+        """
+        owners = self.builder.owners[self.occurrence_bounds[unit_idx]:self.occurrence_bounds[unit_idx + 1]]
+        return [self.builder.chars_list[i] for i in owners.tolist()]
 
     def get_text(self, unit_idx:int) -> str:
         """
-        Get the text of the narrative unit
+        Get the text of the narrative unit. It is sliced from the docs on every call unless it was set
+        with update_text
 
         :param unit_idx: index of the narrative unit
         :return: text of the narrative unit
@@ -113,7 +191,7 @@ class NarrativeUnits:
     
     def update_text(self, unit_idx:int, text:str) -> None:
         """
-        Update the text of the narrative unit
+        Replace the text of the narrative unit (kept in memory from then on)
 
         :param unit_idx: index of the narrative unit
         :param text: new text of the narrative unit
@@ -173,4 +251,51 @@ class NarrativeUnits:
     
     def items(self):
         return self.units.items()
-    
+
+
+class _Unit(MutableMapping):
+    """
+    Properties of one narrative unit.
+    "text" and "characters" are always keys of the unit: they are computed from the docs and the shared
+    occurrences on every access unless they are set, and they show up in iteration, in, keys(), items() and get()
+    like the stored properties. dict(unit) materializes every property.
+    """
+    LAZY_KEYS = ("text", "characters")
+
+    def __init__(self, units:NarrativeUnits, unit_idx:int):
+        self._units = units
+        self._unit_idx = unit_idx
+        self._data = {}
+
+    def _compute(self, key:str):
+        if key == "text":
+            start, end, _ = self._units.spans[self._unit_idx].tolist()
+            return self._units.builder.span_text(start, end)
+        return self._units.get_characters(self._unit_idx)
+
+    def __getitem__(self, key):
+        if key in self._data:
+            return self._data[key]
+        if key in self.LAZY_KEYS:
+            return self._compute(key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value) -> None:
+        self._data[key] = value
+
+    def __delitem__(self, key) -> None:
+        # a lazy key falls back to its computed value
+        del self._data[key]
+
+    def __iter__(self):
+        yield from self.LAZY_KEYS
+        yield from (key for key in self._data if key not in self.LAZY_KEYS)
+
+    def __len__(self) -> int:
+        return len(self.LAZY_KEYS) + sum(1 for key in self._data if key not in self.LAZY_KEYS)
+
+    def __contains__(self, key) -> bool:
+        return key in self.LAZY_KEYS or key in self._data
+
+    def __repr__(self) -> str:
+        return f"_Unit({dict(self)!r})"
@@ -0,0 +1,168 @@
+import numpy as np
+import weakref
+from spacy.attrs import SENT_START, IDX, LENGTH
+from spacy.tokens import Doc
+
+
+def newline_tokens(doc:Doc) -> np.ndarray:
+    """
+    :return: boolean mask of the tokens whose text contains a line break
+    """
+    text = doc.text
+    if len(doc) == 0 or "\n" not in text:
+        return np.zeros(len(doc), dtype=bool)
+    # character offsets of every line break
+    newlines = np.flatnonzero(np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32) == ord("\n"))
+    idx, length = doc.to_array([IDX, LENGTH]).astype(np.int64, copy=False).T
+    return np.searchsorted(newlines, idx) < np.searchsorted(newlines, idx + length)
+
+
+def paragraph_bounds(doc:Doc) -> tuple[np.ndarray, np.ndarray]:
+    """
+    A paragraph ends right before a token (other than the first one) that contains a line break,
+    and the next paragraph starts right after that token.
+
+    :return: start and end (exclusive) token indices of each paragraph
+    """
+    breaks = np.flatnonzero(newline_tokens(doc))
+    breaks = breaks[breaks > 0]
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.append(breaks, len(doc))
+    return starts, ends
+
+
+def sentence_starts(doc:Doc) -> np.ndarray:
+    """
+    :return: token index of the first token of each sentence
+    """
+    if len(doc) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # SENT_START: 1 for a sentence start, -1 (as uint64) otherwise, 0 if unset
+    is_start = doc.to_array([SENT_START]).astype(np.int64, copy=False).reshape(-1) == 1
+    is_start[0] = True
+    return np.flatnonzero(is_start)
+
+
+class PositionIndex:
+    """
+    Token positions of a story, computed once and shared by every stage.
+    Token indices are global over the docs of the story: the tokens of the k-th doc (in the order of the docs
+    dictionary) start at doc_offsets[k]. Every "which sentence/paragraph/unit contains token i" lookup
+    is a searchsorted over the start arrays.
+    """
+    def __init__(self, docs):
+        """
+        :param docs: dictionary of Doc objects of a story, or a single Doc
+        """
+        if isinstance(docs, Doc):
+            docs = {0: docs}
+        self.docs = list(docs.values())
+        self.doc_keys = list(docs.keys())
+        lengths = [len(doc) for doc in self.docs]
+        # doc_offsets[k] is the global index of the first token of the k-th doc; the last element is the total
+        self.doc_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        sent_starts, sent_docs, para_starts, para_ends = [], [], [], []
+        for k, doc in enumerate(self.docs):
+            offset = self.doc_offsets[k]
+            starts = sentence_starts(doc)
+            sent_starts.append(starts + offset)
+            sent_docs.append(np.full(len(starts), k, dtype=np.int64))
+            p_starts, p_ends = paragraph_bounds(doc)
+            para_starts.append(p_starts + offset)
+            para_ends.append(p_ends + offset)
+
+        self.sent_starts = np.concatenate(sent_starts or [np.zeros(0)]).astype(np.int64)
+        # the first token of every doc starts a sentence, so a sentence never spans two docs
+        self.sent_ends = np.append(self.sent_starts[1:], self.doc_offsets[-1])
+        self.sent_docs = np.concatenate(sent_docs or [np.zeros(0)]).astype(np.int64)
+        self.para_starts = np.concatenate(para_starts or [np.zeros(0)]).astype(np.int64)
+        self.para_ends = np.concatenate(para_ends or [np.zeros(0)]).astype(np.int64)
+        self.unit_starts = None
+
+        # per-token ids
+        tokens = np.arange(self.doc_offsets[-1])
+        self.sent_ids = self.sentence_of(tokens)
+        self.para_ids = self.paragraph_of(tokens)
+        self.unit_ids = None
+
+    def __len__(self) -> int:
+        """
+        :return: number of tokens of the story
+        """
+        return int(self.doc_offsets[-1])
+
+    @property
+    def n_sents(self) -> int:
+        return len(self.sent_starts)
+
+    def set_units(self, unit_starts) -> None:
+        """
+        Register the narrative units as the global token index of their first token
+
+        :param unit_starts: ascending start token of each unit, the first one being 0
+        """
+        self.unit_starts = np.asarray(unit_starts, dtype=np.int64)
+        self.unit_ids = self.unit_of(np.arange(len(self)))
+
+    def sentence_of(self, tokens):
+        """
+        :param tokens: global token index or an array of them
+        :return: sentence id of each token
+        """
+        return np.searchsorted(self.sent_starts, tokens, side="right") - 1
+
+    def paragraph_of(self, tokens):
+        """
+        :param tokens: global token index or an array of them
+        :return: paragraph id of each token; a line-break token belongs to the paragraph before it
+        """
+        return np.searchsorted(self.para_starts, tokens, side="right") - 1
+
+    def unit_of(self, tokens):
+        """
+        :param tokens: global token index or an array of them
+        :return: unit id of each token
+        """
+        if self.unit_starts is None:
+            raise ValueError("No narrative units registered. Call set_units first.")
+        return np.searchsorted(self.unit_starts, tokens, side="right") - 1
+
+    def doc_of(self, tokens):
+        """
+        :param tokens: global token index or an array of them
+        :return: position of the doc (in the docs dictionary) of each token
+        """
+        return np.searchsorted(self.doc_offsets[1:], tokens, side="right")
+
+    def doc_position(self, doc:Doc) -> int:
+        """
+        :return: position of the given Doc object in the docs dictionary
+        """
+        for k, d in enumerate(self.docs):
+            if d is doc:
+                return k
+        raise ValueError("The Doc object is not indexed.")
+
+    def sentence(self, sent_id:int):
+        """
+        :return: the sentence as a Span of its doc
+        """
+        k = int(self.sent_docs[sent_id])
+        offset = self.doc_offsets[k]
+        return self.docs[k][int(self.sent_starts[sent_id] - offset):int(self.sent_ends[sent_id] - offset)]
+
+
+# one index per Doc for the Doc/Token extensions, dropped with the Doc
+_doc_positions = weakref.WeakKeyDictionary()
+
+
+def get_positions(doc:Doc) -> PositionIndex:
+    """
+    :return: the PositionIndex of a single Doc, built on first use
+    """
+    positions = _doc_positions.get(doc)
+    if positions is None or len(positions) != len(doc):
+        positions = PositionIndex(doc)
+        _doc_positions[doc] = positions
+    return positions
@@ -0,0 +1,84 @@
+import spacy
+
+from src.models import mbank, mcreator
+
+
+class StubCache:
+    """
+    In-memory stand-in of mbank.DocCache that records every lookup
+    """
+    def __init__(self, nlp, texts):
+        self.docs = {mbank.doc_key(text, mbank.pipeline_signature(nlp)): nlp.make_doc(text) for text in texts}
+        self.lookups = 0
+        self.flushed = False
+
+    def get(self, key, vocab, use_mmap=False, flush=True):
+        self.lookups += 1
+        return self.docs.get(key)
+
+    def put(self, key, doc, title=None):
+        self.docs[key] = doc
+
+    def flush(self):
+        self.flushed = True
+
+
+class CountingPipe:
+    """
+    Wraps nlp.pipe to count the texts it parses
+    """
+    def __init__(self, nlp):
+        self.pipe = nlp.pipe
+        self.parsed = []
+
+    def __call__(self, texts, **kwargs):
+        def count():
+            for item in texts:
+                # with as_tuples, nlp.pipe calls itself again on the bare texts; count the (text, context) pairs
+                if isinstance(item, tuple):
+                    self.parsed.append(item)
+                yield item
+        return self.pipe(count(), **kwargs)
+
+
+def make_stories(n, consumed):
+    for i in range(n):
+        consumed.append(i)
+        yield f"story {i}", f"Text of story number {i}."
+
+
+def test_fully_cached_corpus_streams_one_doc_at_a_time(monkeypatch):
+    nlp = spacy.blank("en")
+    cache = StubCache(nlp, [f"Text of story number {i}." for i in range(5)])
+    monkeypatch.setattr(mbank, "doc_cache", cache)
+    pipe = CountingPipe(nlp)
+    monkeypatch.setattr(nlp, "pipe", pipe)
+
+    consumed = []
+    docs = mcreator.create_spacy_models(make_stories(5, consumed), nlp=nlp, call_old_model=True)
+    title, doc = next(docs)
+    # the first doc comes out before the rest of the corpus is read
+    assert title == "story 0" and doc.text == "Text of story number 0."
+    assert consumed == [0] and cache.lookups == 1
+
+    rest = list(docs)
+    assert [title for title, _ in rest] == [f"story {i}" for i in range(1, 5)]
+    assert pipe.parsed == []
+    assert cache.flushed
+
+
+def test_mixed_corpus_keeps_the_input_order(monkeypatch):
+    nlp = spacy.blank("en")
+    cached = [0, 1, 4]
+    cache = StubCache(nlp, [f"Text of story number {i}." for i in cached])
+    monkeypatch.setattr(mbank, "doc_cache", cache)
+    pipe = CountingPipe(nlp)
+    monkeypatch.setattr(nlp, "pipe", pipe)
+
+    consumed = []
+    docs = list(mcreator.create_spacy_models(make_stories(6, consumed), nlp=nlp, call_old_model=True, save_model=True))
+    assert [title for title, _ in docs] == [f"story {i}" for i in range(6)]
+    assert [doc.text for _, doc in docs] == [f"Text of story number {i}." for i in range(6)]
+    # only the unsaved stories are parsed, and they are saved
+    assert [title for _, (title, _) in pipe.parsed] == ["story 2", "story 3", "story 5"]
+    assert len(cache.docs) == 6
@@ -0,0 +1,40 @@
+import spacy
+
+from src.features.char_id.character_identification import CharacterIdentification
+from src.tools.character import SOURCE_NER, SOURCE_MATCHER
+
+
+def run_sweep(text:str):
+    """
+    Tag the first "Sherlock Holmes" as PERSON, leave the other mentions untagged, and run the sweep
+    :return: the doc and the detected characters
+    """
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    doc = nlp(text)
+    start = text.index("Sherlock Holmes")
+    doc.ents = [doc.char_span(start, start + len("Sherlock Holmes"), label="PERSON")]
+    chars, _ = CharacterIdentification(nlp, doc).run(sweep=True)
+    return doc, chars
+
+
+def test_sweep_counts_each_untagged_mention_once():
+    doc, chars = run_sweep("Sherlock Holmes lit his pipe. Later Sherlock Holmes smiled. Sherlock ran. "
+                           "Then Sherlock Holmes left.")
+
+    assert chars.get_names() == ["Sherlock Holmes"]
+    char = chars.get_character_from_name("Sherlock Holmes")
+    sherlock = [token.i for token in doc if token.text == "Sherlock"]
+    assert sorted(char.occurences) == sherlock
+    assert char.occurences_from(SOURCE_NER) == sherlock[:1]
+    assert sorted(char.occurences_from(SOURCE_MATCHER)) == sherlock[1:]
+
+
+def test_sweep_counts_the_name_without_its_title_once():
+    doc, chars = run_sweep("Mr. Sherlock Holmes lit his pipe. Later Sherlock Holmes smiled. "
+                           "Mr. Sherlock Holmes sat down. Then Sherlock Holmes left.")
+
+    assert chars.get_names() == ["Mr. Sherlock Holmes"]
+    char = chars.get_character_from_name("Mr. Sherlock Holmes")
+    # one occurrence per mention, at its first token after the title
+    assert sorted(char.occurences) == [token.i for token in doc if token.text == "Sherlock"]
@@ -0,0 +1,26 @@
+import os
+
+from src.data import make_dataset
+from src.tools.data_based_name_parser import NameParserChecker, name_cache
+
+
+def test_cache_hit_reparses_after_lexicon_source_changes(monkeypatch):
+    # check the source files on every lookup
+    monkeypatch.setattr(make_dataset.lexicon, "check_interval", 0)
+    name_cache.clear()
+
+    NameParserChecker("Mr. Sherlock Holmes")
+    NameParserChecker("Mr. Sherlock Holmes")
+    assert name_cache.cache_info().hits == 1
+    misses = name_cache.cache_info().misses
+
+    path = make_dataset._pt.get_target_dir(make_dataset.get_lexicon_sources()[0])
+    stat = os.stat(path)
+    try:
+        # a new modification time is an edit as far as the lexicon can tell
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        NameParserChecker("Mr. Sherlock Holmes")
+        assert name_cache.cache_info().misses == misses + 1
+    finally:
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        make_dataset.lexicon.reload()